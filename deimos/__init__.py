@@ -1,23 +1,13 @@
 #!/usr/bin/env python
-import calendar
-import os
-import signal
-import subprocess
 import sys
-import time
 
-import deimos.cleanup
-import deimos.config
-import deimos.containerizer
-import deimos.containerizer.docker
-from deimos.err import Err
-import deimos.flock
-from deimos.logger import log
-import deimos.sig
-import deimos.usage
+# NB: Deimos is started anew for every call the Mesos slave makes, so modules
+#     are imported only by the subcommands that need them. In particular, the
+#     Protobuf modules are only loaded for containerizer subcommands.
 
 
 def cli(argv=None):
+    import deimos.sig
     deimos.sig.install(lambda _: None)
     if argv is None:
         argv = sys.argv
@@ -27,7 +17,14 @@ def cli(argv=None):
         print format_help()
         return 0
 
-    conf = deimos.config.load_configuration()
+    if sub == "bench":
+        import deimos.bench
+        return deimos.bench.cli(argv[2:])
+
+    import deimos.config
+    from deimos.logger import log
+    rebuild = sub == "config" and "--rebuild" in argv[2:]
+    conf = deimos.config.load_configuration(rebuild=rebuild)
 
     if sub == "config":
         log.info("Final configuration:")
@@ -36,32 +33,135 @@ def cli(argv=None):
         return 0
 
     if sub == "locks":
-        deimos.flock.lock_browser(os.path.join(conf.state.root, "mesos"))
+        import os
+        import deimos.flock
+        fmt = "json" if "--json" in argv[2:] else "table"
+        if "--stats" in argv[2:]:
+            import deimos.lockstats
+            try:
+                window = [float(a) for a in argv[2:]
+                          if not a.startswith("--")]
+            except ValueError:
+                print >>sys.stderr, format_help()
+                log.error("Bad ARGV: %r" % argv[1:])
+                return 1
+            deimos.lockstats.report(conf.state.root, *window[:1], fmt=fmt)
+            return 0
+        deimos.flock.lock_browser(os.path.join(conf.state.root, "mesos"),
+                                  fmt=fmt)
         return 0
 
+    if sub == "events":
+        import deimos.events
+        configure_docker(conf)
+        configure_state(conf)
+        return deimos.events.Subscriber(conf.state.root).run()
+
+    if sub == "prefetch":
+        import deimos.prefetch
+        configure_docker(conf)
+        watch = "--watch" in argv[2:]
+        images = [arg for arg in argv[2:] if arg != "--watch"]
+        images = images if images else conf.prefetch.images
+        if watch:
+            deimos.prefetch.watch(images, conf.prefetch.parallel,
+                                          conf.prefetch.interval)
+        failed = deimos.prefetch.prefetch(images, conf.prefetch.parallel)
+        return 4 if failed else 0
+
     if sub == "state":
-        cleanup = deimos.cleanup.Cleanup(conf.state.root)
+        import calendar
+        import time
+        import deimos.cleanup
+        configure_state(conf)
+        watch = "--watch" in argv[2:]
+        cleanup = deimos.cleanup.Cleanup(conf.state.root,
+                                         optimistic=watch,
+                                         parallel=conf.cleanup.parallel,
+                                         rate=conf.cleanup.rate,
+                                         bandwidth=conf.cleanup.bandwidth)
         t, rm = time.time(), False
+        if "--reindex" in argv[2:]:
+            import deimos.index
+            deimos.index.Index(conf.state.root).rebuild()
+            return 0
+        if "--migrate" in argv[2:]:
+            return cleanup.migrate(conf.state.layout == "sharded")
+        if watch:
+            deimos.cleanup.Collector(cleanup,
+                                     max_age=conf.cleanup.max_age,
+                                     max_count=conf.cleanup.max_count,
+                                     max_bytes=conf.cleanup.max_bytes,
+                                     interval=conf.cleanup.interval,
+                                     busy=conf.cleanup.busy).run()
         for arg in argv[2:]:
             if arg == "--rm":
                 rm = True
                 continue
             t = calendar.timegm(time.strptime(arg, "%Y-%m-%dT%H:%M:%SZ"))
         if rm:
-            return cleanup.remove(t)
+            import json
+            code = cleanup.remove(t)
+            if cleanup.summary is not None:
+                sys.stdout.write(json.dumps(cleanup.summary, sort_keys=True))
+                sys.stdout.write("\n")
+            return code
         else:
             for d in cleanup.dirs(t):
                 sys.stdout.write(d + "\n")
             return 0
 
-    if sub not in deimos.containerizer.methods():
+    import deimos.containerizer
+    if sub not in deimos.containerizer.methods() | set(["serve"]):
         print >>sys.stderr, format_help()
         print >>sys.stderr, "** Please specify a subcommand **".center(79)
         log.error("Bad ARGV: %r" % argv[1:])
         return 1
 
+    import deimos.server
+    if sub == "serve":
+        path = argv[2] if len(argv) > 2 else conf.server.socket
+        if path is None:
+            log.error("Please set [server] socket or pass a socket path")
+            return 1
+        containerizer = build_containerizer(conf)
+        deimos.server.Server(path, containerizer, dispatch).serve()
+        return 0
+
+    if conf.server.socket is not None:
+        code = deimos.server.forward(conf.server.socket, argv)
+        if code is not None:
+            return code
+
+    return dispatch(build_containerizer(conf), argv)
+
+
+def configure_docker(conf):
+    import os
+    import deimos.docker
+    import deimos.images
     deimos.docker.options = conf.docker.argv()
-    containerizer = deimos.containerizer.docker.Docker(
+    deimos.docker.api = conf.api.enable
+    images = os.path.join(conf.state.root, "images")
+    deimos.docker.image_cache = deimos.images.Cache(images)
+
+
+def configure_state(conf):
+    import deimos.state
+    deimos.state.backend = conf.state.backend
+    deimos.state.durability = conf.state.durability
+    deimos.state.layout = conf.state.layout
+    deimos.state.lock_stats = conf.state.lock_stats
+    if conf.state.index:
+        import deimos.index
+        deimos.state.index = deimos.index.Index(conf.state.root)
+
+
+def build_containerizer(conf):
+    import deimos.containerizer.docker
+    configure_docker(conf)
+    configure_state(conf)
+    return deimos.containerizer.docker.Docker(
         container_settings=conf.containers,
         index_settings=conf.index,
         optimistic_unpack=conf.uris.unpack,
@@ -69,6 +169,14 @@ def cli(argv=None):
         state_root=conf.state.root
     )
 
+
+def dispatch(containerizer, argv):
+    import subprocess
+    import deimos.containerizer
+    from deimos.err import Err
+    from deimos.logger import log
+    import deimos.usage
+    sub = argv[1]
     deimos.usage.report()
     try:
         result = deimos.containerizer.stdio(containerizer, *argv[1:])
@@ -102,8 +210,13 @@ def format_help():
         deimos destroy
         deimos wait
         deimos observe <mesos-container-id>
-        deimos locks
-        deimos state
+        deimos locks (--stats (<seconds>)?)? (--json)?
+        deimos state (--rm|--reindex|--migrate|--watch)?
+        deimos config (--rebuild)?
+        deimos events
+        deimos prefetch (--watch)? <image>*
+        deimos serve <socket>?
+        deimos bench (startup|logger|processes|state|durability|locks)
 
   Deimos provides Mesos integration for Docker, allowing Docker to be used as
   an external containerizer.
@@ -136,19 +249,74 @@ def format_help():
   Observes the Mesos container ID, in a way that blocks all calls to `wait`.
   It is for internal use...probably don't want to play with this one.
 
- deimos locks
+ deimos locks (--stats (<seconds>)?)? (--json)?
 
-  List file locks taken by Deimos, associating each file with a PID, an inode,
-  and a lock level. The same file may appear multiple times.
+  List the file locks held on the state of containers: for each, the lock
+  file, the lock level (EX or SH), the holding PID and its Deimos subcommand,
+  and for exclusive locks, how long the lock has been held. A file with
+  several shared holders appears once for each. With --stats, summarizes
+  the lock metrics recorded over the last hour (or the given number of
+  seconds) instead: for each lock and level, how many were taken and timed
+  out, and the 50th, 95th and 99th percentile of the time spent waiting
+  for and holding them. With --json, prints JSON instead of a table.
 
- deimos state (--rm)?
+ deimos state (--rm|--reindex|--migrate|--watch)?
 
   List stale state directories (those with an exit file). With --rm, removes
-  stale states.
-
- deimos config
-
-  Load and display the configuration.
+  stale states, a few at a time and at the rates set in the [cleanup]
+  section of the configuration, and prints a summary as JSON. With
+  --reindex, rebuilds the state index (see the [state] section of the
+  configuration) from the state directories. With --migrate, moves the
+  state of exited containers into the configured layout. With
+  --watch, runs forever, removing the state of exited containers as needed
+  to stay within the retention limits set in the [cleanup] section.
+
+ deimos config (--rebuild)?
+
+  Load and display the configuration. The parsed configuration is cached
+  until the configuration file changes; with --rebuild, the file is parsed
+  again and the cache regenerated.
+
+ deimos events
+
+  Follow the Docker event stream and write the exit file of each container
+  that dies. While this runs, watchers forked by launch wait for that file
+  instead of each running `docker wait`. Requires the Docker API.
+
+ deimos prefetch (--watch)? <image>*
+
+  Pull the given images, or those listed in the [prefetch] section of the
+  configuration, a few at a time, so that launches don't wait on a pull.
+  With --watch, pulls them again at the configured interval, forever, which
+  picks up tags that have moved.
+
+ deimos serve <socket>?
+
+  Run a resident Deimos server on a UNIX socket (by default, the socket set
+  in the [server] section of the configuration). When that socket is set,
+  containerizer subcommands are forwarded to the server, which keeps the
+  configuration and containerizer loaded; if no server is listening, they
+  run locally as usual. Calls to wait on running containers are parked in
+  the server, rather than each run in a process of its own, until the exit
+  is written.
+
+ deimos bench (startup|logger|processes|state|durability|locks)
+
+  Microbenchmarks. The startup benchmark reports how long each Deimos module
+  takes to import in a fresh interpreter, alongside the cost of starting the
+  interpreter itself. The logger benchmark reports the per-call cost of
+  logger lookup and of log calls filtered out by level. The processes
+  benchmark counts the resident Deimos and Docker client processes on the
+  host, by subcommand, with their total RSS. The state benchmark counts the
+  file system calls made on the state directory by a launch, under each
+  state backend; it takes the number of launches and, optionally, the
+  directory to put its scratch state root in. The durability benchmark
+  reports launches per second under each [state] durability mode; it takes
+  the number of launches, the number of processes launching at once, and
+  the directories to try, for example a tmpfs and an ext4 mount. The locks
+  benchmark reports how long threads contending for one lock wait to take
+  it, and how promptly fractional lock timeouts expire; it takes the number
+  of threads, the number of locks each takes and how long each is held.
 
 """.strip("\n")
 
@@ -0,0 +1,412 @@
+import __builtin__
+import fcntl
+from fcntl import LOCK_EX
+import inspect
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Modules whose import cost matters on the command line, roughly in the order
+# the subcommands load them.
+startup_modules = ["deimos",
+                   "deimos.sig",
+                   "deimos.logger",
+                   "deimos.config",
+                   "deimos.flock",
+                   "deimos.state",
+                   "deimos.cleanup",
+                   "deimos.server",
+                   "deimos.docker",
+                   "deimos.containerizer",
+                   "deimos.proto",
+                   "deimos.mesos_pb2",
+                   "deimos.containerizer_pb2",
+                   "deimos.containerizer.docker"]
+
+
+def cli(argv):
+    benchmarks = {"startup": startup, "logger": logger,
+                  "processes": processes, "state": state,
+                  "durability": durability, "locks": locks}
+    if len(argv) < 1 or argv[0] not in benchmarks:
+        names = ", ".join(sorted(benchmarks.keys()))
+        print >>sys.stderr, "Please choose a benchmark: %s" % names
+        return 1
+    return benchmarks[argv[0]](*argv[1:])
+
+
+def startup(repeat=5):
+    """
+    Time the import of each module in a fresh interpreter, so that every
+    measurement includes the module's dependencies, as it would for a
+    subcommand that imports it first. Reports milliseconds.
+    """
+    repeat = int(repeat)
+    fmt = "%-32s %10s %10s"
+    print fmt % ("module", "median", "min")
+    rows = [("(interpreter)", interpreter(repeat))]
+    rows += [(m, [import_time(m) for _ in range(repeat)])
+             for m in startup_modules]
+    for name, samples in rows:
+        if None in samples:
+            print fmt % (name, "failed", "-")
+            continue
+        print fmt % (name, "%0.2f" % median(samples), "%0.2f" % min(samples))
+    return 0
+
+
+def import_time(module):
+    code = ("import time; t = time.time(); import %s; "
+            "print (time.time() - t) * 1000" % module)
+    p = subprocess.Popen([sys.executable, "-c", code],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, _ = p.communicate()
+    if p.returncode != 0:
+        return None
+    return float(out)
+
+
+def interpreter(repeat):
+    samples = []
+    for _ in range(repeat):
+        t = time.time()
+        subprocess.check_call([sys.executable, "-c", "pass"])
+        samples += [(time.time() - t) * 1000]
+    return samples
+
+
+def median(samples):
+    ordered = sorted(samples)
+    return ordered[len(ordered) // 2]
+
+
+def logger(n=20000):
+    """
+    Per-call cost of finding the calling function's logger, by walking the
+    stack with inspect (as Deimos once did) and with the memoized frame walk,
+    and of a log.debug() call filtered out by level. Reports microseconds.
+    """
+    import deimos.logger
+    n = int(n)
+    level = deimos.logger.root.level
+    deimos.logger.root.setLevel(logging.INFO)
+    try:
+        rows = [("inspect.stack()", per_call(lambda: stack_logger(1), n)),
+                ("deimos.logger.logger()",
+                 per_call(lambda: deimos.logger.logger(1), n)),
+                ("log.debug() (filtered)",
+                 per_call(lambda: deimos.logger.log.debug("%s", n), n))]
+    finally:
+        deimos.logger.root.setLevel(level)
+    fmt = "%-32s %10s"
+    print fmt % ("lookup", "usec/call")
+    for name, usec in rows:
+        print fmt % (name, "%0.3f" % usec)
+    return 0
+
+
+def stack_logger(height=1):
+    caller = inspect.stack()[height]
+    scope = caller[0].f_globals
+    path = scope["__name__"]
+    return logging.getLogger(path + "." + caller[3] + "()")
+
+
+def per_call(f, n):
+    t = time.time()
+    for _ in xrange(n):
+        f()
+    return (time.time() - t) * 1e6 / n
+
+
+def processes():
+    """
+    Count resident Deimos processes by subcommand, and docker CLI processes by
+    command, with their total RSS -- for example, to compare the watchers left
+    running by launch with and without the event subscriber.
+    """
+    counts = {}
+    page = resource.getpagesize()
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/%s/cmdline" % pid) as h:
+                argv = h.read().split("\0")[:-1]
+            with open("/proc/%s/statm" % pid) as h:
+                rss = int(h.read().split()[1]) * page
+        except (IOError, IndexError):          # Exited while we were looking
+            continue
+        kind = classify(argv)
+        if kind is not None:
+            n, total = counts.get(kind, (0, 0))
+            counts[kind] = (n + 1, total + rss)
+    fmt = "%-32s %10s %10s"
+    print fmt % ("process", "count", "rss (M)")
+    for kind in sorted(counts):
+        n, rss = counts[kind]
+        print fmt % (kind, n, "%0.1f" % (rss / 1048576.0))
+    return 0
+
+
+def classify(argv):
+    for i, arg in enumerate(argv):
+        base = os.path.basename(arg)
+        if base == "docker":
+            commands = [a for a in argv[i + 1:] if a in docker_commands]
+            return "docker " + (commands[0] if commands else "")
+        if base == "deimos" or arg in ["deimos.__init__", "deimos"]:
+            rest = argv[i + 1:]
+            return "deimos " + (rest[0] if rest else "")
+    return None
+
+
+docker_commands = set(["run", "wait", "stop", "inspect", "pull", "ps",
+                       "events"])
+
+
+def state(n=200, directory=None):
+    """
+    Count the file system calls made for the state directory of one launch,
+    followed by a wait call, under each state backend, along with the time
+    taken, in a scratch state root under the given directory (by default,
+    the system's temporary directory). Calls are counted as Python makes them;
+    reads and writes come from /proc/self/io, and opening a file object is
+    counted as the open(), fstat() and close() it costs.
+    """
+    import deimos.logger
+    import deimos.state
+    n = int(n)
+    level, backend = deimos.logger.root.level, deimos.state.backend
+    deimos.logger.root.setLevel(logging.WARNING)
+    rows = []
+    try:
+        for name in ["files", "record"]:
+            deimos.state.backend = name
+            root = tempfile.mkdtemp(prefix="deimos-bench-", dir=directory)
+            counts = {}
+            restore = instrument(counts)
+            io, t = proc_io(), time.time()
+            try:
+                for i in xrange(n):
+                    simulate_launch(root, i)
+            finally:
+                t, io = time.time() - t, proc_io(io)
+                restore()
+                shutil.rmtree(root)
+            counts.update(io)
+            rows += [(name, counts, t)]
+    finally:
+        deimos.logger.root.setLevel(level)
+        deimos.state.backend = backend
+    calls = sorted(set(k for _, counts, _ in rows for k in counts))
+    fmt = "%-16s" + " %10s" * len(rows)
+    print fmt % tuple(["per launch"] + [name for name, _, _ in rows])
+    for call in calls + ["(total)"]:
+        per = [sum(counts.values()) if call == "(total)" else
+               counts.get(call, 0) for _, counts, _ in rows]
+        print fmt % tuple([call] + ["%0.1f" % (float(c) / n) for c in per])
+    print fmt % tuple(["usec"] + ["%0.1f" % (t * 1e6 / n)
+                                  for _, _, t in rows])
+    return 0
+
+
+def durability(n=400, parallel=8, *directories):
+    """
+    Launch throughput under each durability mode for state writes, with
+    parallel processes launching at once, in a scratch state root under
+    each directory -- by default, /dev/shm and the system's temporary
+    directory, which are often a tmpfs and a disk file system. Reports
+    launches per second.
+    """
+    import deimos.durability
+    import deimos.logger
+    import deimos.state
+    n, parallel = int(n), int(parallel)
+    if len(directories) == 0:
+        directories = [d for d in ["/dev/shm", tempfile.gettempdir()]
+                       if os.path.isdir(d)]
+    modes = deimos.durability.modes
+    level, mode = deimos.logger.root.level, deimos.state.durability
+    deimos.logger.root.setLevel(logging.WARNING)
+    fmt = "%-24s" + " %10s" * len(modes)
+    print fmt % tuple(["launches/s"] + modes)
+    try:
+        for directory in directories:
+            rates = []
+            for m in modes:
+                deimos.state.durability = m
+                root = tempfile.mkdtemp(prefix="deimos-bench-", dir=directory)
+                try:
+                    rates += ["%0.1f" % (n / launches(root, n, parallel))]
+                finally:
+                    shutil.rmtree(root)
+            print fmt % tuple([directory] + rates)
+    finally:
+        deimos.logger.root.setLevel(level)
+        deimos.state.durability = mode
+    return 0
+
+
+def locks(threads=8, n=50, hold=0.002):
+    """
+    Lock acquisition under contention, with deimos.flock.LK: threads in one
+    process each take an exclusive lock on the same file n times, holding
+    it for hold seconds and then pausing for up to as long. The time
+    spent waiting for each lock is reported in milliseconds, along with the
+    mean time the lock sat free between holders; then how far past a
+    fractional timeout a waiter gives up, for a lock that is never released.
+    """
+    import threading
+    import deimos.flock
+    threads, n, hold = int(threads), int(n), float(hold)
+    directory = tempfile.mkdtemp(prefix="deimos-bench-")
+    path = os.path.join(directory, "lock")
+    waits, held = [], []
+
+    def contend():
+        for _ in xrange(n):
+            lk = deimos.flock.LK(path, LOCK_EX, 60)
+            t = time.time()
+            lk.lock()
+            waits.append(time.time() - t)
+            time.sleep(hold)
+            held.append(time.time() - t - waits[-1])
+            lk.unlock()
+            time.sleep(hold * random.random())      # Don't just take it back
+    try:
+        t = time.time()
+        workers = [threading.Thread(target=contend) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - t
+        overshoot = dict((seconds, timeout_overshoot(path, seconds))
+                         for seconds in [0.05, 0.2])
+    finally:
+        shutil.rmtree(directory)
+    ms = sorted(w * 1000 for w in waits)
+    fmt = "%-32s %10s"
+    print fmt % ("%d threads x %d locks" % (threads, n), "msec")
+    for name, p in [("wait p50", 0.5), ("wait p95", 0.95),
+                    ("wait p99", 0.99), ("wait max", 1.0)]:
+        print fmt % (name, "%0.3f" % ms[min(int(p * len(ms)), len(ms) - 1)])
+    free = (elapsed - sum(held)) / len(held)
+    print fmt % ("free between holders", "%0.3f" % (free * 1000))
+    for seconds, late in sorted(overshoot.items()):
+        print fmt % ("%gs timeout, overshoot" % seconds,
+                     "%0.3f" % (late * 1000))
+    return 0
+
+
+def timeout_overshoot(path, seconds, trials=5):
+    "Median seconds past the timeout that a waiter on a held lock gives up."
+    import deimos.flock
+    samples = []
+    holder = deimos.flock.LK(path, LOCK_EX)
+    holder.lock()
+    try:
+        for _ in range(trials):
+            t = time.time()
+            try:
+                deimos.flock.LK(path, LOCK_EX, seconds).lock()
+            except deimos.flock.Timeout:
+                samples += [time.time() - t - seconds]
+    finally:
+        holder.unlock()
+    return median(samples)
+
+
+def launches(root, n, parallel):
+    "Seconds taken for parallel processes to make n simulated launches."
+    t, pids = time.time(), []
+    for k in range(parallel):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                for i in xrange(k, n, parallel):
+                    simulate_launch(root, i)
+            except Exception:
+                logging.exception("Simulated launch failed")
+                code = 1
+            os._exit(code)
+        pids += [pid]
+    failures = [pid for pid in pids if os.waitpid(pid, 0)[1] != 0]
+    if len(failures) > 0:
+        raise RuntimeError("%d of %d processes failed" %
+                           (len(failures), parallel))
+    return time.time() - t
+
+
+def simulate_launch(root, i):
+    "The state operations of launch and of one wait, in the same order."
+    import deimos.state
+    state = deimos.state.State(root, mesos_id="bench-%d" % i)
+    state.batch()
+    state.push()
+    lk_l = state.lock("launch", LOCK_EX)
+    state.executor_id = "executor-%d" % i
+    state.push()
+    state.ids()
+    state.pid(os.getpid())
+    with open(state.resolve("cid"), "w") as h:   # As `docker run --cidfile`
+        h.write("%064x" % i)
+    state.await_cid()
+    state.push()
+    state.flush()
+    lk_w = state.lock("wait", LOCK_EX)
+    lk_l.unlock()
+    state.ids()
+    waiter = deimos.state.State(root, mesos_id="bench-%d" % i)
+    waiter.await_launch().unlock()
+    waiter.ids()
+    state.exit("0")
+    lk_w.unlock()
+    waiter.exit()
+
+
+def instrument(counts):
+    """
+    Count calls to the os, fcntl and builtin functions that map to file
+    system calls. Returns a function that removes the instrumentation.
+    """
+    targets = [(os, name) for name in ["stat", "lstat", "open", "close",
+                                       "rename", "symlink", "mkdir",
+                                       "unlink", "listdir", "readlink",
+                                       "fsync", "utime"]]
+    targets += [(fcntl, "flock"), (__builtin__, "open")]
+    originals = [(module, name, getattr(module, name))
+                 for module, name in targets]
+    labels = {(__builtin__, "open"): ["open", "fstat", "close"]}
+
+    def counted(names, f):
+        def wrapper(*args, **kwargs):
+            for name in names:
+                counts[name] = counts.get(name, 0) + 1
+            return f(*args, **kwargs)
+        return wrapper
+    for module, name, f in originals:
+        setattr(module, name, counted(labels.get((module, name), [name]), f))
+
+    def restore():
+        for module, name, f in originals:
+            setattr(module, name, f)
+    return restore
+
+
+def proc_io(since=None):
+    "Read and write system calls made so far, from /proc/self/io."
+    with open("/proc/self/io") as h:
+        fields = dict(line.split(": ") for line in h.read().splitlines())
+    io = {"read": int(fields["syscr"]), "write": int(fields["syscw"])}
+    if since is not None:
+        io = dict((k, v - since[k]) for k, v in io.items())
+    return io
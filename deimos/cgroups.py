@@ -1,4 +1,7 @@
+import errno
 import logging
+import math
+import os
 
 from deimos.logger import log
 from deimos._struct import _Struct
@@ -15,6 +18,20 @@ class CGroups(_Struct):
         _Struct.__init__(self, **properties)
         log.debug(" ".join(self.keys()))
 
+    def statistics(self):
+        """
+        Fields of a ResourceStatistics message: the memory and CPU limits and
+        the RSS, and where the unified hierarchy is in use, CPU times and
+        throttling from cpu.stat as well. Limits that can't be read are left
+        out.
+        """
+        stats = dict(mem_limit_bytes=self.memory.limit(),
+                     cpus_limit=self.cpu.limit(),
+                     mem_rss_bytes=self.memory.rss())
+        if isinstance(getattr(self, "cpuacct", None), UnifiedCPUAcct):
+            stats.update(self.cpuacct.statistics())
+        return dict((k, v) for k, v in stats.items() if v is not None)
+
 
 class CGroup(object):
 
@@ -30,7 +47,7 @@ class CGroup(object):
             with open(path) as h:
                 data = h.read()
             return data
-        except OSError as e:
+        except (IOError, OSError) as e:
             if e.errno != errno.ENOENT:
                 raise e
             log.warning("Could not read %s.%s (%s)", self.name, key, path)
@@ -46,9 +63,20 @@ def construct(path, name=None):
     classes = {"memory": Memory,
                "cpu": CPU,
                "cpuacct": CPUAcct}
+    prefix = name
+    if unified(path):
+        classes = {"memory": UnifiedMemory,
+                   "cpu": UnifiedCPU,
+                   "cpuacct": UnifiedCPUAcct}
+        prefix = {"cpuacct": "cpu"}.get(name, name)   # Its files are cpu.*
     constructor = classes.get(name, CGroup)
     log.debug("Chose %s for: %s", constructor.__name__, path)
-    return constructor(path, name)
+    return constructor(path, prefix)
+
+
+def unified(path):
+    "Whether the cgroup is in the unified (version 2) hierarchy."
+    return os.path.exists(os.path.join(path, "cgroup.controllers"))
 
 
 class Memory(CGroup):
@@ -81,6 +109,82 @@ class CPUAcct(CGroup):
         return float(self.stat_data().system) / 100
 
 
+# The unified hierarchy has one directory per cgroup, with every controller's
+# files in it, and different files and units from version 1; these classes
+# give the same answers as the ones above.
+
+
+class UnifiedMemory(CGroup):
+
+    def rss(self):
+        "Anonymous memory, which is what version 1 reports as rss."
+        return int(self.stat_data().anon)
+
+    def usage(self):
+        "All memory charged to the cgroup, page cache included."
+        return int(self.current)
+
+    def limit(self):
+        data = self.max.strip()
+        return unlimited if data == "max" else int(data)
+
+
+class UnifiedCPU(CGroup):
+
+    def limit(self):
+        """
+        As for CPU.limit(), shares over 1024, or None where there is no
+        cpu.weight (as in the root cgroup). The shares are recovered from
+        cpu.weight, which runc and crun derive from them as:
+
+          l = log2(shares)
+          weight = 10^((l^2 + 125 * l) / 612 - 7/34)
+
+        This maps 2, 1024 and 262144 shares to weights of 1, 100 and 10000,
+        so that the default weight of 100 reads as the default 1024 shares.
+        """
+        weight = self.weight
+        if weight is None:
+            return None
+        exponent = math.log10(int(weight)) + 7.0 / 34
+        log2 = (math.sqrt(125 ** 2 + 4 * 612 * exponent) - 125) / 2
+        return float(int(round(2 ** log2))) / 1024
+
+    def quota(self):
+        "The CPUs the cgroup may use, from cpu.max, or None if unlimited."
+        if self.max is None:
+            return None
+        quota, period = self.max.split()
+        return None if quota == "max" else float(quota) / float(period)
+
+
+class UnifiedCPUAcct(CGroup):
+
+    def user_time(self):
+        "Total user time for container in seconds."
+        return float(self.stat_data().user_usec) / 1e6
+
+    def system_time(self):
+        "Total system time for container in seconds."
+        return float(self.stat_data().system_usec) / 1e6
+
+    def statistics(self):
+        "CPU times and throttling, as ResourceStatistics fields."
+        stat = self.stat_data()
+        stats = dict(cpus_user_time_secs=float(stat.user_usec) / 1e6,
+                     cpus_system_time_secs=float(stat.system_usec) / 1e6)
+        if "nr_periods" in stat.keys():        # Only with the cpu controller
+            stats.update(cpus_nr_periods=int(stat.nr_periods),
+                         cpus_nr_throttled=int(stat.nr_throttled),
+                         cpus_throttled_time_secs=(
+                             float(stat.throttled_usec) / 1e6))
+        return stats
+
+
+# What version 1 reports as the memory limit of an unlimited cgroup
+unlimited = 9223372036854771712
+
+
 class StatFile(_Struct):
 
     def __init__(self, data):
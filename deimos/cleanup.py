@@ -1,46 +1,59 @@
+import errno
 from fcntl import LOCK_EX, LOCK_NB
-import glob
+import json
 import os
-import subprocess
+import Queue
+import stat
+import threading
 import time
 
-from deimos.cmd import Run
 import deimos.flock
 from deimos.logger import log
+import deimos.state
 from deimos.timestamp import iso
 from deimos._struct import _Struct
 
 
 class Cleanup(_Struct):
 
-    def __init__(self, root="/tmp/deimos", optimistic=False):
+    def __init__(self, root="/tmp/deimos", optimistic=False, parallel=4,
+                       rate=None, bandwidth=None):
         _Struct.__init__(self, root=root,
                                optimistic=optimistic,
-                               lock=os.path.join(root, "cleanup"))
+                               lock=os.path.join(root, "cleanup"),
+                               parallel=parallel,
+                               rate=rate,
+                               bandwidth=bandwidth,
+                               summary=None)
 
-    def dirs(self, before=time.time(), exited=True):
+    def dirs(self, before=None, exited=True):
         """
-        Provider a generator of container state directories.
+        Provider a generator of container state directories, for containers
+        started before the given time (by default, now), oldest first.
 
         If exited is None, all are returned. If it is False, unexited
         containers are returned. If it is True, only exited containers are
         returned.
         """
         timestamp = iso(before)
-        root = os.path.join(self.root, "start-time")
-        os.chdir(root)
-        by_t = (d for d in glob.iglob("????-??-??T*.*Z") if d < timestamp)
+        if deimos.state.index is not None:
+            starts = deimos.state.index.started_before(timestamp, exited)
+            return (deimos.state.locate(self.root, "start-time", t)[0]
+                    for t in starts)
+        by_t = (p for _, p in deimos.state.start_times(self.root, timestamp))
         if exited is None:
             def predicate(directory):
                 return True
         else:
             def predicate(directory):
-                exit = os.path.join(directory, "exit")
-                return os.path.exists(exit) is exited
-        return (os.path.join(root, d) for d in by_t if predicate(d))
+                return deimos.state.exited(directory) is exited
+        return (d for d in by_t if predicate(d))
 
     def remove(self, *args, **kwargs):
-        errors = 0
+        return self.remove_dirs(self.dirs(*args, **kwargs))
+
+    def remove_dirs(self, dirs):
+        "Remove the state for each start-time/ entry, under the lock."
         lk = deimos.flock.LK(self.lock, LOCK_EX | LOCK_NB)
         try:
             lk.lock()
@@ -51,23 +64,349 @@ class Cleanup(_Struct):
                 return 0
             else:
                 log.error(msg)
-                raise e
+                raise
+        remover = Remover(self.parallel, self.rate, self.bandwidth)
         try:
-            for d in self.dirs(*args, **kwargs):
-                state = deimos.state.state(d)
-                if state is None:
-                    log.warning("Not able to load state from: %s", d)
+            remover.run(dirs)
+        finally:
+            self.unindex(remover.removed)
+            lk.unlock()
+        self.summary = remover.summary
+        log.info("summary // %s", json.dumps(self.summary, sort_keys=True))
+        if self.summary["failed"] != 0:
+            log.error("There were failures on %d directories",
+                      self.summary["failed"])
+            return 4
+        return 0
+
+    def migrate(self, sharded=True):
+        """
+        Move the state of exited containers into the sharded layout (or, if
+        sharded is False, back into the flat one), under the cleanup lock.
+        Containers still running are left where they are -- both layouts are
+        read -- and can be moved by a later run.
+        """
+        lk = deimos.flock.LK(self.lock, LOCK_EX | LOCK_NB)
+        try:
+            lk.lock()
+        except deimos.flock.Err:
+            log.error("Lock unavailable -- is cleanup already running?")
+            raise
+        moved = 0
+        try:
+            for mesos_id, path in list(deimos.state.entries(self.root,
+                                                            "mesos")):
+                target = deimos.state.entry(self.root, "mesos", mesos_id,
+                                            sharded)
+                if path == target or not deimos.state.exited(path):
                     continue
-                try:
-                    cmd = ["rm", "-rf", d + "/"]
-                    cmd += [state._mesos()]
-                    if state.cid() is not None:
-                        cmd += [state._docker()]
-                    Run()(cmd)
-                except subprocess.CalledProcessError:
-                    errors += 1
+                state = deimos.state.State(self.root, mesos_id=mesos_id)
+                cid, t = state.cid(), state.t()
+                deimos.state.create(os.path.dirname(target))
+                os.rename(path, target)
+                if cid is not None:
+                    self.relink("docker", cid, target, sharded)
+                if t is not None:
+                    self.relink("start-time", t, target, sharded)
+                moved += 1
         finally:
             lk.unlock()
+        log.info("Moved %d state directories", moved)
+        return 0
+
+    def relink(self, kind, ident, target, sharded):
+        old, found = deimos.state.locate(self.root, kind, ident)
+        if found:
+            os.unlink(old)
+        new = deimos.state.entry(self.root, kind, ident, sharded)
+        deimos.state.create(os.path.dirname(new))
+        try:
+            os.symlink(os.path.relpath(target, os.path.dirname(new)), new)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise e
+
+    def unindex(self, mesos_ids):
+        if deimos.state.index is None or len(mesos_ids) == 0:
+            return
+        from deimos.index import failures
+        try:
+            deimos.state.index.remove(mesos_ids)
+        except failures as e:
+            log.warning("Not able to update the index (%s); rebuild it with "
+                        "`deimos state --reindex`", e)
+
+
+class Collector(_Struct):
+
+    """
+    Keeps the state root within retention limits, for as long as it runs:
+    exited containers are removed once they are older than max_age seconds,
+    and the oldest exited containers are removed while there are more than
+    max_count containers or their state takes more than max_bytes. (A limit
+    of 0 is no limit.) Running containers are never removed.
+
+    Each pass reads only the start-time/ entries added since the last one
+    and checks only the containers not yet seen to exit; the size of a
+    container's state is measured once, when it has exited. Every resync
+    passes, the tracking is rebuilt from scratch, to pick up removals made
+    by others. Passes are skipped, with a growing delay, while the disk
+    holding the state root is busier than the busy fraction.
+
+    Removal goes through Cleanup.remove_dirs(), so it takes the cleanup lock
+    and a pass is skipped while a manual cleanup holds it.
+    """
+
+    def __init__(self, cleanup, max_age=0, max_count=0, max_bytes=0,
+                       interval=60, busy=0.5, resync=60):
+        _Struct.__init__(self, cleanup=cleanup,
+                               max_age=max_age,
+                               max_count=max_count,
+                               max_bytes=max_bytes,
+                               interval=interval,
+                               busy=busy,
+                               resync=resync,
+                               tracked={},
+                               newest=None,
+                               disk=DiskLoad(cleanup.root))
+
+    def run(self):
+        passes, delay = 0, 0                   # The first pass is made at once
+        while True:
+            time.sleep(delay)
+            load = self.disk.busy() if passes > 0 else None
+            if load is not None and load > self.busy:
+                delay = min(delay * 2, self.interval * 16)
+                log.info("Disk is %d%% busy; next pass in %ds",
+                         load * 100, delay)
+                continue
+            delay = self.interval
+            if passes % self.resync == 0:
+                self.tracked, self.newest = {}, None
+            passes += 1
+            self.scan()
+            doomed = self.select()
+            if len(doomed) == 0:
+                continue
+            self.cleanup.remove_dirs(doomed)
+            for path in doomed:
+                if not os.path.lexists(path):
+                    del self.tracked[path]
+
+    def scan(self):
+        root = self.cleanup.root
+        for t, path in deimos.state.start_times(root, after=self.newest):
+            self.tracked[path] = [t, False, 0]
+            self.newest = max(t, self.newest)
+        for path, entry in self.tracked.items():
+            if not entry[1] and deimos.state.exited(path):
+                entry[1], entry[2] = True, usage(os.path.realpath(path))
+
+    def select(self):
+        "Start-time entries to remove, oldest first."
+        exited = sorted((t, path, size)
+                        for path, (t, done, size) in self.tracked.items()
+                        if done)
+        cutoff = iso(time.time() - self.max_age) if self.max_age else None
+        count = len(self.tracked)
+        total = sum(size for _, _, size in exited)
+        doomed = []
+        for t, path, size in exited:
+            old = cutoff is not None and t < cutoff
+            many = self.max_count and count > self.max_count
+            large = self.max_bytes and total > self.max_bytes
+            if not (old or many or large):
+                break
+            doomed += [path]
+            count, total = count - 1, total - size
+        return doomed
+
+
+def usage(path):
+    "Bytes in the files under path, without following symlinks."
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return 0
+    if not stat.S_ISDIR(st.st_mode):
+        return st.st_size if stat.S_ISREG(st.st_mode) else 0
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return 0
+    return sum(usage(os.path.join(path, name)) for name in names)
+
+
+class DiskLoad(object):
+
+    """
+    The fraction of time the disk holding a path spent doing I/O between
+    one call to busy() and the next, from /proc/diskstats; or None, if the
+    path is not on a disk listed there (as with a tmpfs), or doesn't exist
+    yet.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.device = None
+        self.last = self.sample()
+
+    def busy(self):
+        now, last = self.sample(), self.last
+        self.last = now
+        if now is None or last is None or now[0] <= last[0]:
+            return None
+        return (now[1] - last[1]) / ((now[0] - last[0]) * 1000.0)
+
+    def sample(self):
+        if self.device is None:
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                return None
+            self.device = (os.major(st.st_dev), os.minor(st.st_dev))
+        try:
+            with open("/proc/diskstats") as h:
+                lines = h.read().splitlines()
+        except IOError:
+            return None
+        for line in lines:
+            fields = line.split()
+            if len(fields) < 13:
+                continue
+            if (int(fields[0]), int(fields[1])) == self.device:
+                return time.time(), int(fields[12])     # ms spent doing I/O
+        return None
+
+
+class Remover(_Struct):
+
+    """
+    Removes container state in-process, with a pool of threads that each
+    take one state directory at a time. Removal can be held to a rate of
+    unlink() and rmdir() calls per second and to a bandwidth, in bytes of
+    files removed per second, so that cleanup doesn't starve running tasks
+    of I/O. Counts of what was removed, and of failures, are kept in the
+    summary.
+    """
+
+    def __init__(self, parallel=4, rate=None, bandwidth=None):
+        _Struct.__init__(self, parallel=max(1, parallel),
+                               ops=Throttle(rate),
+                               bytes=Throttle(bandwidth),
+                               removed=[],
+                               summary=dict(states=0, failed=0, files=0,
+                                            directories=0, links=0,
+                                            bytes=0, errors=0, seconds=0.0),
+                               mutex=threading.Lock())
+
+    def run(self, dirs):
+        "Remove the state for each start-time/ entry in dirs."
+        start = time.time()
+        queue = Queue.Queue(self.parallel * 4)
+        threads = [threading.Thread(target=self.worker, args=(queue,))
+                   for _ in range(self.parallel)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for d in dirs:
+                queue.put(d)
+        finally:
+            for _ in threads:
+                queue.put(None)
+            for thread in threads:
+                while thread.is_alive():   # Joining with a timeout leaves the
+                    thread.join(0.5)       # main thread able to take signals
+        self.summary["seconds"] = time.time() - start
+        return self.summary
+
+    def worker(self, queue):
+        while True:
+            d = queue.get()
+            if d is None:
+                return
+            try:
+                self.state(d)
+            except Exception:
+                log.exception("Failed to remove %s", d)
+                self.count("failed")
+
+    def state(self, d):
+        state = deimos.state.state(d)
+        if state is None:
+            log.warning("Not able to load state from: %s", d)
+            return
+        paths = [state._mesos(), d]              # Entry last, so a partial
+        if state.cid() is not None:              # removal is found again
+            paths = [state._docker()] + paths
+        errors = sum(self.tree(p) for p in paths)
         if errors != 0:
-            log.error("There were failures on %d directories", errors)
-            return 4
+            self.count("failed")
+            return
+        self.count("states")
+        with self.mutex:
+            self.removed.append(state.mesos_id)
+
+    def tree(self, path):
+        "Remove a file, symlink or directory tree; returns the failure count."
+        try:
+            st = os.lstat(path)
+        except OSError as e:
+            return self.failure(e, path)
+        if not stat.S_ISDIR(st.st_mode):
+            kind = "links" if stat.S_ISLNK(st.st_mode) else "files"
+            size = st.st_size if kind == "files" else 0
+            return self.op(os.unlink, path, kind, size)
+        try:
+            names = os.listdir(path)
+        except OSError as e:
+            return self.failure(e, path)
+        errors = sum(self.tree(os.path.join(path, n)) for n in names)
+        return errors + self.op(os.rmdir, path, "directories")
+
+    def op(self, f, path, kind, size=0):
+        self.ops.take(1)
+        self.bytes.take(size)
+        try:
+            f(path)
+        except OSError as e:
+            return self.failure(e, path)
+        self.count(kind)
+        self.count("bytes", size)
+        return 0
+
+    def failure(self, e, path):
+        if e.errno == errno.ENOENT:             # Already gone is just as good
+            return 0
+        log.warning("Not able to remove %s: %s", path, e)
+        self.count("errors")
+        return 1
+
+    def count(self, key, n=1):
+        with self.mutex:
+            self.summary[key] += n
+
+
+class Throttle(object):
+
+    """
+    Spaces out uses of a resource, from any number of threads, so that no
+    more than rate units are taken per second. With no rate, take() returns
+    at once.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.mutex = threading.Lock()
+        self.next = time.time()
+
+    def take(self, n=1):
+        if not self.rate or n <= 0:
+            return
+        with self.mutex:
+            now = time.time()
+            start = max(now, self.next)
+            self.next = start + float(n) / self.rate
+        if start > now:
+            time.sleep(start - now)
@@ -1,24 +1,30 @@
-from ConfigParser import SafeConfigParser, NoSectionError
+import errno
 import json
 import logging
 import os
+import re
+import stat
 import sys
 
 import deimos.argv
-import deimos.docker
 from deimos.logger import log
 import deimos.logger
 from deimos._struct import _Struct
 
 
-def load_configuration(f=None, interactive=sys.stdout.isatty()):
+def load_configuration(f=None, interactive=sys.stdout.isatty(),
+                       rebuild=False):
     error = None
     defaults = _Struct(docker=Docker(),
+                       api=DockerAPI(),
                        index=DockerIndex(),
                        containers=Containers(),
                        uris=URIs(),
                        state=State(),
                        hooks=Hooks(),
+                       server=Server(),
+                       prefetch=Prefetch(),
+                       cleanup=Cleanup(),
                        log=Log(
                        console=(logging.DEBUG if interactive else None),
                        syslog=(logging.INFO if not interactive else None)
@@ -27,7 +33,7 @@ def load_configuration(f=None, interactive=sys.stdout.isatty()):
     try:
         f = f if f else path()
         if f:
-            parsed = parse(f)
+            parsed, hit = compiled(f, rebuild)
     except Exception as e:
         error = e
     finally:
@@ -38,7 +44,8 @@ def load_configuration(f=None, interactive=sys.stdout.isatty()):
             log.exception(pre + str(error))
             sys.exit(16)
         if parsed:
-            log.info("Loaded configuration from %s" % f)
+            cache_note = " (cached)" if hit else ""
+            log.info("Loaded configuration from %s%s" % (f, cache_note))
             for _, conf in parsed.items():
                 log.debug("Found: %r", conf)
     return confs
@@ -160,6 +167,12 @@ class Docker(_Struct):
         return deimos.argv.argv(**dict(self.items()))
 
 
+class DockerAPI(_Struct):
+
+    def __init__(self, enable=True):
+        _Struct.__init__(self, enable=coercebool(enable))
+
+
 class DockerIndex(_Struct):
 
     def __init__(self, index=None, account_libmesos="libmesos",
@@ -173,21 +186,67 @@ class DockerIndex(_Struct):
 
 class State(_Struct):
 
-    def __init__(self, root="/tmp/deimos"):
+    def __init__(self, root="/tmp/deimos", backend="files", index=False,
+                       durability="none", layout="flat", lock_stats=True):
         if ":" in root:
             raise ValueError("Deimos root storage path must not contain ':'")
-        _Struct.__init__(self, root=root)
+        if backend not in ["files", "record"]:
+            raise ValueError("State backend must be one of: files, record")
+        if durability not in ["none", "atomic", "fsync", "group"]:
+            raise ValueError("State durability must be one of: "
+                             "none, atomic, fsync, group")
+        if layout not in ["flat", "sharded"]:
+            raise ValueError("State layout must be one of: flat, sharded")
+        _Struct.__init__(self, root=root,
+                               backend=backend,
+                               index=coercebool(index),
+                               durability=durability,
+                               layout=layout,
+                               lock_stats=coercebool(lock_stats))
+
+
+class Prefetch(_Struct):
+
+    def __init__(self, images=[], parallel=4, interval=3600):
+        _Struct.__init__(self, images=coercearray(images),
+                               parallel=int(parallel),
+                               interval=float(interval))
+
+
+class Cleanup(_Struct):
+
+    def __init__(self, parallel=4, rate=0, bandwidth=0, max_age=0,
+                       max_count=0, max_bytes=0, interval=60, busy=0.5):
+        _Struct.__init__(self, parallel=int(parallel),
+                               rate=float(rate),
+                               bandwidth=float(bandwidth),
+                               max_age=float(max_age),
+                               max_count=int(max_count),
+                               max_bytes=int(max_bytes),
+                               interval=float(interval),
+                               busy=float(busy))
+
+
+class Server(_Struct):
+
+    def __init__(self, socket=None):
+        _Struct.__init__(self, socket=socket)
 
 
 def parse(f):
+    from ConfigParser import SafeConfigParser
     config = SafeConfigParser()
     config.read(f)
     parsed = {}
     sections = [("log", Log), ("state", State), ("uris", URIs),
                 ("docker", Docker),
+                ("docker.api", DockerAPI),
                 ("docker.index", DockerIndex),
                 ("containers.image", Image),
                 ("hooks", Hooks),
+                ("server", Server),
+                ("prefetch", Prefetch),
+                ("cleanup", Cleanup),
                 ("containers.options", Options)]
     for key, cls in sections:
         try:
@@ -203,12 +262,136 @@ def parse(f):
         del parsed["containers.options"]
     if len(containers) > 0:
         parsed["containers"] = Containers(**containers)
+    if "docker.api" in parsed:
+        parsed["api"] = parsed["docker.api"]
+        del parsed["docker.api"]
     if "docker.index" in parsed:
         parsed["index"] = parsed["docker.index"]
         del parsed["docker.index"]
     return _Struct(**parsed)
 
 
+def compiled(f, rebuild=False):
+    """
+    Parse the configuration file, reusing the parsed sections stored in the
+    cache file as long as the source file's mtime, size and inode match. The
+    cache is rewritten whenever the file is parsed. Returns the parsed
+    configuration and whether it came from the cache.
+    """
+    key, cache = signature(f), cache_file(f)
+    if not rebuild:
+        parsed = read_cache(cache, key)
+        if parsed is not None:
+            return parsed, True
+    parsed = parse(f)
+    write_cache(cache, key, parsed)
+    return parsed, False
+
+
+def signature(f):
+    st = os.stat(f)
+    return [os.path.abspath(f), st.st_mtime, st.st_size, st.st_ino]
+
+
+def cache_file(f):
+    """
+    The cache for the configuration file: config.cache under the state root
+    it sets, found by scanning the file for the root option of [state] --
+    which is much cheaper than parsing it -- or under the default root.
+    """
+    root, section = State().root, None
+    with open(f) as h:
+        for line in h:
+            header = re.match(r"\[([^\]]+)\]", line)
+            if header is not None:
+                section = header.group(1).strip()
+                continue
+            option = re.match(r"root\s*[:=]\s*(.*\S)", line)
+            if section == "state" and option is not None:
+                root = option.group(1)
+    return os.path.join(root, "config.cache")
+
+
+def trusted(st):
+    """
+    Whether a file or directory with this stat is ours alone: owned by the
+    effective user and not writable by group or others. Anything else may
+    have been planted, and is not read from or written into.
+    """
+    writable = st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    return st.st_uid == os.geteuid() and writable == 0
+
+
+def read_cache(cache, key):
+    try:
+        if not trusted(os.stat(os.path.dirname(cache))):
+            return None
+        with open(cache) as h:
+            if not trusted(os.fstat(h.fileno())):
+                return None
+            data = json.load(h)
+        if data.get("version") != cache_version or data.get("key") != key:
+            return None
+        return thaw(data["parsed"])
+    except Exception:     # Missing, corrupt or stale caches are just misses
+        return None
+
+
+def write_cache(cache, key, parsed):
+    data = {"version": cache_version, "key": key, "parsed": freeze(parsed)}
+    tmp = "%s.%d" % (cache, os.getpid())
+    d = os.path.dirname(cache)
+    try:
+        if not os.path.exists(d):
+            os.makedirs(d)
+        if not trusted(os.stat(d)):
+            log.warning("Not caching configuration in %s: it is not owned "
+                        "by this user alone", d)
+            return
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW
+        with os.fdopen(os.open(tmp, flags, 0600), "w") as h:
+            json.dump(data, h, separators=(",", ":"))
+        os.rename(tmp, cache)
+    except (IOError, OSError) as e:
+        if e.errno != errno.EEXIST and os.path.exists(tmp):
+            os.unlink(tmp)
+        if e.errno not in [errno.EACCES, errno.EPERM, errno.EROFS,
+                           errno.EEXIST]:
+            raise e
+
+
+def freeze(value):
+    "Converts a tree of configuration structs to plain JSON data."
+    if isinstance(value, _Struct):
+        fields = [[k, freeze(v)] for k, v in value.items()]
+        return {"struct": type(value).__name__, "fields": fields}
+    if isinstance(value, list):
+        return [freeze(v) for v in value]
+    return value
+
+
+def thaw(data):
+    """
+    Rebuilds configuration structs from the output of freeze(), without
+    calling their constructors -- the values were coerced when the file was
+    parsed.
+    """
+    if isinstance(data, dict):
+        cls = globals()[data["struct"]]
+        if not issubclass(cls, _Struct):
+            raise ValueError("Not a configuration struct: %s" % cls)
+        obj = cls.__new__(cls)
+        fields = [(str(k), thaw(v)) for k, v in data["fields"]]
+        _Struct.__init__(obj, **dict(fields))
+        obj._properties = [k for k, _ in fields]
+        return obj
+    if isinstance(data, list):
+        return [thaw(v) for v in data]
+    if isinstance(data, unicode):
+        return data.encode("utf-8")
+    return data
+
+
 def path():
     for p in search_path:
         if os.path.exists(p):
@@ -219,3 +402,5 @@ search_path = ["./deimos.cfg",
                "/etc/deimos.cfg",
                "/usr/etc/deimos.cfg",
                "/usr/local/etc/deimos.cfg"]
+
+cache_version = 7                  # Bump when configuration structs change
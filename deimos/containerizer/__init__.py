@@ -4,16 +4,9 @@ import os
 import re
 import subprocess
 
-try:                  # Prefer system installation of Mesos protos if available
-    from mesos_pb2 import *
-    from containerizer_pb2 import *
-except:
-    from deimos.mesos_pb2 import *
-    from deimos.containerizer_pb2 import *
-
 import deimos.cmd
+from deimos.err import Err
 from deimos.logger import log
-from deimos.proto import recordio
 
 
 class Containerizer(object):
@@ -79,13 +72,15 @@ def stdio(containerizer, *args):
         observe <id>
 
     """
+    from deimos.proto import recordio
+    pb2 = containerizer_pb2()
     try:
         name = args[0]
-        method, proto = {"launch": (containerizer.launch, Launch),
-                          "update": (containerizer.update, Update),
-                          "usage": (containerizer.usage, Usage),
-                          "wait": (containerizer.wait, Wait),
-                          "destroy": (containerizer.destroy, Destroy),
+        method, proto = {"launch": (containerizer.launch, pb2.Launch),
+                          "update": (containerizer.update, pb2.Update),
+                          "usage": (containerizer.usage, pb2.Usage),
+                          "wait": (containerizer.wait, pb2.Wait),
+                          "destroy": (containerizer.destroy, pb2.Destroy),
                           "containers": (containerizer.containers, None),
                           "recover": (containerizer.recover, None),
                           "observe": (containerizer.observe, None)}[name]
@@ -100,6 +95,20 @@ def stdio(containerizer, *args):
         return method(*args[1:])
 
 
+def containerizer_pb2():
+    """
+    The containerizer Protobuf module, loaded on first use. Prefers a system
+    installation of the Mesos protos, if one is available.
+    """
+    try:
+        import mesos_pb2
+        import containerizer_pb2
+    except:
+        import deimos.mesos_pb2
+        import deimos.containerizer_pb2 as containerizer_pb2
+    return containerizer_pb2
+
+
 # Mesos interface helpers
 
 MESOS_ESSENTIAL_ENV = ["MESOS_SLAVE_ID", "MESOS_SLAVE_PID",
@@ -57,10 +57,18 @@ class Docker(Containerizer, _Struct):
         log.info(" ".join(args))
         fork = False if "--no-fork" in args else True
         deimos.sig.install(self.log_signal)
-        run_options = []
         launchy = deimos.mesos.Launch(launch_pb)
         state = deimos.state.State(self.state_root,
                                    mesos_id=launchy.container_id)
+        state.batch()                  # Written together, by flush() below
+        try:
+            return self.start(launchy, state, fork)
+        finally:
+            state.flush()              # Also when the launch fails part way
+
+    def start(self, launchy, state, fork):
+        "Launch, after batch(); then, unless forking, watch the container."
+        run_options = []
         state.push()
         lk_l = state.lock("launch", LOCK_EX)
         state.executor_id = launchy.executor_id
@@ -164,6 +172,7 @@ class Docker(Containerizer, _Struct):
                     state.pid(self.runner.pid)
                     state.await_cid()
                     state.push()
+                    state.flush()           # Before waiters can read it
                     lk_w = state.lock("wait", LOCK_EX)
                     lk_l.unlock()
                     if fork:
@@ -190,8 +199,14 @@ class Docker(Containerizer, _Struct):
                                                           stdout=obs_out,
                                                           stderr=obs_err,
                                                           close_fds=True)
-        data = Run(data=True)(deimos.docker.wait(state.cid()))
-        state.exit(data)
+        from deimos.events import await_exit
+        if not await_exit(state):
+            try:
+                state.exit(deimos.docker.client().wait(state.cid()))
+            except deimos.docker.failures() as e:
+                if state.exit() is None:       # Removed, by --rm, unseen
+                    log.warning("No exit code for %s: %s", state.cid(), e)
+                    state.exit("unknown")
         lk_w.unlock()
         for p, arr in [(self.runner, runner_argv), (observer, observer_argv)]:
             if p is None:
@@ -250,11 +265,7 @@ class Docker(Containerizer, _Struct):
         try:
             recordio.write(ResourceStatistics,
                            timestamp=time.time(),
-                           mem_limit_bytes=cg.memory.limit(),
-                           cpus_limit=cg.cpu.limit(),
-                           # cpus_user_time_secs   = cg.cpuacct.user_time(),
-                           # cpus_system_time_secs = cg.cpuacct.system_time(),
-                           mem_rss_bytes=cg.memory.rss())
+                           **cg.statistics())
         except AttributeError as e:
             log.error("Missing CGroup!")
             raise e
@@ -307,20 +318,32 @@ class Docker(Containerizer, _Struct):
         state.await_launch()
         lk_d = state.lock("destroy", LOCK_EX)
         if state.exit() is None:
-            Run()(deimos.docker.stop(state.cid()))
+            deimos.docker.client().stop(state.cid())
         else:
             log.info("Container is stopped")
         return 0
 
     def containers(self, *args):
         log.info(" ".join(args))
-        data = Run(data=True)(deimos.docker.docker("ps", "--no-trunc", "-q"))
         mesos_ids = []
-        for line in data.splitlines():
-            cid = line.strip()
-            state = deimos.state.State(self.state_root, docker_id=cid)
+        held = deimos.flock.held_exclusively()   # One read of /proc/locks
+        indexed = None
+        if deimos.state.index is not None:
+            indexed = dict(deimos.state.index.running())
+        for cid in deimos.docker.client().containers():
+            if indexed is not None:
+                if cid not in indexed:
+                    continue
+                state = deimos.state.State(self.state_root,
+                                           mesos_id=indexed[cid])
+            else:
+                state = deimos.state.State(self.state_root, docker_id=cid)
             if not state.exists():
                 continue
+            if held is not None:         # LOCK_EX held, so launch() is running
+                if state.held("wait", held):
+                    mesos_ids += [state.mesos_container_id()]
+                continue
             try:
                 state.lock("wait", LOCK_SH | LOCK_NB)
             except deimos.flock.Err:     # LOCK_EX held, so launch() is running
@@ -340,8 +363,8 @@ class Docker(Containerizer, _Struct):
             cid = self.state.cid()
             log.info("Trying to stop Docker container: %s", cid)
             try:
-                Run()(deimos.docker.stop(cid))
-            except subprocess.CalledProcessError:
+                deimos.docker.client().stop(cid)
+            except deimos.docker.failures():
                 pass
             return deimos.sig.Resume()
 
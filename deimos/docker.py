@@ -6,6 +6,7 @@ import os
 import re
 import subprocess
 import sys
+import threading
 import time
 
 from deimos.cmd import Run
@@ -17,7 +18,7 @@ from deimos._struct import _Struct
 def run(options, image, command=[], env={}, cpus=None, mems=None, ports=[]):
     envs = env.items() if isinstance(env, dict) else env
     pairs = [("-e", "%s=%s" % (k, v)) for k, v in envs]
-    if ports != []:               # NB: Forces external call to pre-fetch image
+    if ports != []:
         port_pairings = list(itertools.izip_longest(ports, inner_ports(image)))
         log.info("Port pairings (Mesos, Docker) // %r", port_pairings)
         for allocated, target in port_pairings:
@@ -47,10 +48,16 @@ def wait(ident):
 
 images = {}                                        # Cache of image information
 
+# Shared with other processes; see deimos.images.Cache
+image_cache = None
+
 
 def pull(image):
-    Run(data=True)(docker("pull", image))
-    refresh_docker_image_info(image)
+    images.clear()                  # It may be in there under another name
+    if image_cache is not None:
+        image_cache.invalidate(image)
+    client().pull(image)
+    return refresh_docker_image_info(image)
 
 
 def pull_once(image):
@@ -61,18 +68,43 @@ def pull_once(image):
 def image_info(image):
     if image in images:
         return images[image]
-    else:
-        return refresh_docker_image_info(image)
+    if image_cache is not None:
+        cached = image_cache.get(image)
+        if cached is not None:
+            images[image] = cached
+            return cached
+    return refresh_docker_image_info(image)
 
 
 def refresh_docker_image_info(image):
     try:
-        text = Run(data=True)(docker("inspect", image))
-        parsed = json.loads(text)[0]
-        images[image] = parsed
-        return parsed
-    except subprocess.CalledProcessError as e:
+        parsed = client().inspect_image(image)
+    except failures() as e:
+        if image_cache is not None:
+            image_cache.drop(image)
         return None
+    images[image] = parsed
+    if image_cache is not None:
+        image_cache.put(image, parsed)
+    return parsed
+
+
+def registry_image_info(image):
+    """
+    Image configuration read from the registry, for images that are not
+    present locally, so that their ports can be found without pulling the
+    layers; `docker run` pulls the image itself. Kept in the image cache
+    apart from the local image's information.
+    """
+    if image_cache is not None:
+        cached = image_cache.get(image, "registry")
+        if cached is not None:
+            return cached
+    from deimos.registry import inspect
+    info = inspect(image)
+    if info is not None and image_cache is not None:
+        image_cache.put(image, info, "registry")
+    return info
 
 
 def ensure_image(f):
@@ -82,9 +114,11 @@ def ensure_image(f):
     return f_
 
 
-@ensure_image
 def inner_ports(image):
-    info = image_info(image)
+    info = image_info(image) or registry_image_info(image)
+    if info is None:          # NB: Forces external call to pre-fetch image
+        pull_once(image)
+        info = image_info(image) or {}
     config = info.get("Config", info.get("config"))
     if config:
         exposed = config.get("ExposedPorts", {})
@@ -104,13 +138,28 @@ class Status(_Struct):
         _Struct.__init__(self, cid=cid, pid=pid, exit=exit)
 
 
-def cgroups(cid):
-    paths = []
-    paths += glob.glob("/sys/fs/cgroup/*/" + cid)
-    paths += glob.glob("/sys/fs/cgroup/*/docker/" + cid)
-    paths += glob.glob("/cgroup/*/" + cid)
-    paths += glob.glob("/cgroup/*/docker/" + cid)
-    named_cgroups = [(s.split("/cgroup/")[1].split("/")[0], s) for s in paths]
+def cgroups(cid, roots=["/sys/fs/cgroup", "/cgroup"]):
+    """
+    The container's cgroups, by controller. Where a root is the unified
+    (version 2) hierarchy, the container has a single cgroup -- under
+    system.slice with the systemd driver, under docker/ otherwise -- which
+    serves for memory, cpu and cpuacct alike.
+    """
+    for root in roots:
+        if not os.path.exists(os.path.join(root, "cgroup.controllers")):
+            continue
+        for path in [os.path.join(root, "system.slice",
+                                  "docker-%s.scope" % cid),
+                     os.path.join(root, "docker", cid)]:
+            if os.path.isdir(path):
+                return dict((name, path)
+                            for name in ["memory", "cpu", "cpuacct"])
+    named_cgroups = []
+    for root in roots:
+        for parent in ["*", os.path.join("*", "docker")]:
+            for path in glob.glob(os.path.join(root, parent, cid)):
+                name = os.path.relpath(path, root).split("/")[0]
+                named_cgroups += [(name, path)]
     return dict(named_cgroups)
 
 
@@ -131,18 +180,18 @@ def image_token(name, account=None, index=None, *args, **kwargs):
 
 
 def probe(ident, quiet=False):
-    fields = "{{.ID}} {{.State.Pid}} {{.State.ExitCode}}"
-    level = logging.DEBUG if quiet else logging.WARNING
-    argv = docker("inspect", "--format=" + fields, ident)
-    run = Run(data=True, error_level=level)
-    text = run(argv).strip()
-    cid, pid, exit = text.split()
+    info = client().inspect_container(ident, quiet=quiet)
+    cid, pid = info.get("Id", info.get("ID")), info["State"]["Pid"]
+    exit = info["State"]["ExitCode"]
     return Status(cid=cid, pid=pid, exit=(exit if pid == 0 else None))
 
 
 def exists(ident, quiet=False):
+    from deimos.engine import NotFound
     try:
         return probe(ident, quiet)
+    except NotFound:
+        return None
     except subprocess.CalledProcessError as e:
         if e.returncode != 1:
             raise e
@@ -177,10 +226,75 @@ class AwaitTimeout(Err):
     pass
 
 
+# Clients
+
+class CLI(_Struct):
+
+    """
+    Runs Docker operations through the docker command line client. Has the
+    same interface as deimos.engine.Client, which is used instead when the
+    Docker API is reachable.
+    """
+
+    def __init__(self):
+        _Struct.__init__(self)
+
+    def containers(self):
+        "IDs of running containers, untruncated."
+        data = Run(data=True)(docker("ps", "--no-trunc", "-q"))
+        return [line.strip() for line in data.splitlines() if line.strip()]
+
+    def inspect_container(self, ident, quiet=False):
+        level = logging.DEBUG if quiet else logging.WARNING
+        text = Run(data=True, error_level=level)(docker("inspect", ident))
+        return json.loads(text)[0]
+
+    def inspect_image(self, image):
+        return json.loads(Run(data=True)(docker("inspect", image)))[0]
+
+    def stop(self, ident):
+        Run()(stop(ident))
+
+    def wait(self, ident):
+        "Blocks until the container exits; returns the code as text."
+        return Run(data=True)(wait(ident)).strip()
+
+    def pull(self, image):
+        Run(data=True)(docker("pull", image))
+
+
+def client():
+    """
+    The Docker client for this process: the Docker API, if it is enabled and
+    reachable with the configured options, or else the docker CLI.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            from deimos.engine import connect
+            _client = connect(options) if api else None
+            if _client is None:
+                _client = CLI()
+            log.debug("Using %s", type(_client).__name__)
+    return _client
+
+
+def failures():
+    "Exceptions raised by either client when an operation fails."
+    from deimos.engine import Err
+    return (subprocess.CalledProcessError, Err)
+
+
 # Global settings
 
 options = []
 
+api = True
+
+_client = None
+
+_client_lock = threading.Lock()
+
 
 def docker(*args):
     return ["docker"] + options + list(args)
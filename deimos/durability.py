@@ -0,0 +1,106 @@
+import ctypes
+import errno
+import fcntl
+import os
+import time
+
+import deimos.libc
+from deimos.logger import log
+
+
+modes = ["none", "atomic", "fsync", "group"]
+
+
+def write(path, data, mode="none", lock=None):
+    """
+    Write data to the file at path, as durably as the mode asks:
+
+      none    Truncate and write the file in place. Readers may see it empty
+              or partly written, and so may a reboot.
+      atomic  Write a temporary file and rename it over the path, so that
+              readers see the old contents or the new ones.
+      fsync   As atomic, syncing the file before the rename and the directory
+              after it, so the new contents survive a crash once this
+              returns.
+      group   As atomic, then wait for a sync of the whole file system that
+              started after the rename. Concurrent writers share syncs; see
+              group_sync(), which takes the lock file to coordinate on.
+    """
+    if mode == "none":
+        with open(path, "w+") as h:
+            h.write(data)
+            h.flush()
+        return
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        os.write(fd, data)
+        if mode == "fsync":
+            os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(tmp, path)
+    if mode == "fsync":
+        fsync_directory(os.path.dirname(path))
+    if mode == "group":
+        group_sync(os.path.dirname(path), lock)
+
+
+def group_sync(directory, lock):
+    """
+    Return once everything written to the directory's file system before
+    the call is on disk. Callers take turns holding the lock; whoever holds
+    it syncs the file system and notes when the sync started, and callers
+    that were waiting meanwhile find that a sync started after their writes
+    and return without syncing again. Under load, a single sync covers the
+    writes of everyone who queued up during the one before it.
+    """
+    written = time.time()
+    fd = os.open(lock, os.O_RDWR | os.O_CREAT, 0644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        last = os.read(fd, 64).strip()
+        if last and float(last) > written:
+            return
+        start = time.time()
+        sync(directory)
+        os.lseek(fd, 0, os.SEEK_SET)             # Fixed width, overwritten in
+        os.write(fd, "%020.6f" % start)          # place: truncating is slow
+    finally:
+        os.close(fd)                               # Releases the lock, too
+
+
+def sync(directory):
+    """
+    Sync the file system the directory is on, with syncfs() or, where that
+    is missing, sync(); without a usable libc, only the directory is synced.
+    """
+    global libc
+    if libc is False:
+        libc = deimos.libc.load("sync")
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        if libc is None:
+            os.fsync(fd)
+            return
+        if getattr(libc, "syncfs", None) is not None:
+            if libc.syncfs(fd) == 0:
+                return
+            log.debug("syncfs: %s", os.strerror(ctypes.get_errno()))
+        libc.sync()
+    finally:
+        os.close(fd)
+
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        if e.errno != errno.EINVAL:            # Not supported by some FSes
+            raise e
+    finally:
+        os.close(fd)
+
+
+libc = False                                       # Loaded on first use
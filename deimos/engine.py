@@ -0,0 +1,238 @@
+import httplib
+import json
+import os
+import socket
+import threading
+import urllib
+
+import deimos.err
+from deimos.logger import log
+from deimos._struct import _Struct
+
+
+class Client(_Struct):
+
+    """
+    A client for the small part of the Docker Engine API that Deimos uses,
+    with the same interface as deimos.docker.CLI. Requests from each thread
+    share one keep-alive connection; calls that block for the life of a
+    container, like wait(), get a connection of their own.
+    """
+
+    def __init__(self, host="unix:///var/run/docker.sock"):
+        _Struct.__init__(self, host=host, local=threading.local())
+
+    def containers(self):
+        "IDs of running containers, untruncated."
+        return [str(c["Id"]) for c in self.request("GET", "/containers/json")]
+
+    def inspect_container(self, ident, quiet=False):
+        return self.request("GET", "/containers/%s/json" % quote(ident))
+
+    def inspect_image(self, image):
+        return self.request("GET", "/images/%s/json" % quote(image))
+
+    def stop(self, ident, t=2):
+        path = "/containers/%s/stop" % quote(ident)
+        self.request("POST", path, query={"t": t}, ok=[304])
+
+    def wait(self, ident):
+        "Blocks until the container exits; returns the code as text."
+        path = "/containers/%s/wait" % quote(ident)
+        conn = connection(self.host)
+        try:
+            result = self.request("POST", path, conn=conn)
+        finally:
+            conn.close()
+        return str(result["StatusCode"])
+
+    def pull(self, image):
+        repository, tag = split_tag(image)
+        query = {"fromImage": repository, "tag": tag}
+        for event in self.request("POST", "/images/create", query=query,
+                                  stream=True):
+            if "error" in event:
+                raise Err("Pull of %s failed: %s" % (image, event["error"]))
+            log.debug("%s // %s", image, event.get("status", event))
+
+    def events(self, **filters):
+        """
+        Subscribes to the daemon's event stream, on a connection of its own,
+        and returns an iterator over events as they happen. HTTP/1.0 is used
+        so that the stream is not chunked and each event arrives as a line.
+        """
+        query = {"filters": json.dumps(filters)} if filters else None
+        url = "/events" + ("?" + urllib.urlencode(query) if query else "")
+        log.debug("call // GET %s", url)
+        conn = connection(self.host)
+        conn._http_vsn, conn._http_vsn_str = 10, "HTTP/1.0"
+        try:
+            conn.request("GET", url)
+            response = conn.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            raise Unavailable("GET %s: %r" % (url, e))
+        if response.status >= 400:
+            conn.close()
+            raise APIError(response.status, "GET %s: %s" %
+                                            (url, response.read().strip()))
+        return event_stream(response, conn, url)
+
+    def ping(self):
+        return self.request("GET", "/_ping", decode=False) == "OK"
+
+    def request(self, method, path, query=None, conn=None, ok=[],
+                      stream=False, decode=True):
+        url = path + ("?" + urllib.urlencode(query) if query else "")
+        log.debug("call // %s %s", method, url)
+        shared = conn is None
+        conn = self.shared() if shared else conn
+        for attempt in [1, 2]:
+            try:
+                conn.request(method, url, headers={"Content-Length": "0"})
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if not shared or attempt == 2:        # Retry only once, and
+                    msg = "%s %s: %r" % (method, url, e)  # only on shared
+                    raise Unavailable(msg)            # connections, which
+                log.debug("Reconnecting after: %r", e)  # may be stale
+                conn = self.shared(reconnect=True)
+        log.debug("exit %d // %s %s", response.status, method, url)
+        if response.status >= 400:
+            cls = NotFound if response.status == 404 else APIError
+            raise cls(response.status, "%s %s: %s" % (method, url,
+                                                      data.strip()))
+        if response.status >= 300 and response.status not in ok:
+            raise APIError(response.status, "%s %s" % (method, url))
+        if not decode or response.status in [204, 304] or data == "":
+            return data
+        return list(json_stream(data)) if stream else json.loads(data)
+
+    def shared(self, reconnect=False):
+        "This thread's keep-alive connection; not inherited across forks."
+        if reconnect or getattr(self.local, "pid", None) != os.getpid():
+            self.local.conn = connection(self.host)
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, socket_path, timeout=None):
+        httplib.HTTPConnection.__init__(self, "localhost")
+        self.socket_path = socket_path
+        self.socket_timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.socket_timeout)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+def connection(host):
+    if host.startswith("unix://"):
+        return UnixHTTPConnection(host[len("unix://"):])
+    if host.startswith("tcp://"):
+        return httplib.HTTPConnection(host[len("tcp://"):])
+    raise Err("Unsupported Docker host: %s" % host)
+
+
+def connect(options=[]):
+    """
+    Find the Docker host in the given docker CLI options (or DOCKER_HOST) and
+    return a Client for it, or None if the daemon can not be reached over
+    plain HTTP -- for example, when TLS is configured.
+    """
+    hosts, tls = [], False
+    for i, opt in enumerate(options):
+        if opt in ["-H", "--host"] and i + 1 < len(options):
+            hosts += [options[i + 1]]
+        elif opt.startswith("--host="):
+            hosts += [opt[len("--host="):]]
+        elif opt.startswith("--tls"):
+            tls = True
+    if len(hosts) == 0:
+        hosts = [os.environ.get("DOCKER_HOST", "unix:///var/run/docker.sock")]
+    if tls or os.environ.get("DOCKER_TLS_VERIFY"):
+        log.debug("TLS is configured; using the docker CLI")
+        return None
+    for host in hosts:
+        try:
+            client = Client(host)
+            if client.ping():
+                return client
+        except Err as e:
+            log.debug("Docker API not available at %s: %s", host, e)
+    return None
+
+
+def split_tag(image):
+    """
+    Splits image references like registry:5000/repo:tag at the tag, or
+    repo@sha256:... at the digest. Without either, the tag is "latest", as
+    for `docker pull` -- the API would otherwise pull every tag.
+    """
+    if "@" in image:
+        name, _, digest = image.partition("@")
+        return name, digest
+    name, _, tag = image.rpartition(":")
+    if name == "" or "/" in tag:
+        return image, "latest"
+    return name, tag
+
+
+def quote(ident):
+    return urllib.quote(ident, safe="/:")
+
+
+def event_stream(response, conn, url):
+    try:
+        while True:
+            line = response.fp.readline()
+            if line == "":
+                return
+            if line.strip() != "":
+                yield json.loads(line)
+    except (httplib.HTTPException, socket.error) as e:
+        raise Unavailable("GET %s: %r" % (url, e))
+    finally:
+        conn.close()
+
+
+def json_stream(data):
+    "Decode the concatenated JSON objects of streaming API responses."
+    decoder, i = json.JSONDecoder(), 0
+    while True:
+        while i < len(data) and data[i].isspace():
+            i += 1
+        if i >= len(data):
+            return
+        obj, i = decoder.raw_decode(data, i)
+        yield obj
+
+
+class Err(deimos.err.Err):
+    pass
+
+
+class APIError(Err):
+
+    def __init__(self, status, message):
+        Err.__init__(self, message)
+        self.status = status
+
+
+class NotFound(APIError):
+    pass
+
+
+class Unavailable(Err):
+    pass
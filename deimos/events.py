@@ -0,0 +1,135 @@
+from fcntl import LOCK_EX, LOCK_NB, LOCK_SH
+import os
+import time
+
+import deimos.docker
+import deimos.engine
+import deimos.flock
+from deimos.logger import log
+import deimos.state
+from deimos._struct import _Struct
+
+
+class Subscriber(_Struct):
+
+    """
+    Follows the Docker event stream and writes the exit file for every
+    container under the state root that dies, so that watchers started by
+    launch() can wait on the file instead of each running `docker wait`.
+
+    Only one subscriber runs per state root; it holds the "events" lock for
+    as long as it is subscribed.
+    """
+
+    def __init__(self, root="/tmp/deimos"):
+        _Struct.__init__(self, root=os.path.abspath(root),
+                               lock=lock_path(root))
+
+    def run(self):
+        client = deimos.docker.client()
+        if not isinstance(client, deimos.engine.Client):
+            raise deimos.engine.Err("The event stream needs the Docker API")
+        lk = deimos.flock.LK(self.lock, LOCK_EX | LOCK_NB)
+        try:
+            lk.lock()
+        except deimos.flock.Locked:
+            log.info("Lock unavailable -- is a subscriber already running?")
+            return 0
+        backoff = 0.5
+        while True:
+            try:
+                events = client.events(event=["die"])
+                self.reconcile(client)           # After subscribing, so no
+                for event in events:             # exit can fall in the gap
+                    backoff = 0.5
+                    self.handle(event)
+                log.warning("Event stream closed by Docker")
+            except deimos.engine.Err as e:
+                log.warning("Event stream failed: %s", e)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+    def handle(self, event):
+        action = event.get("Action", event.get("status"))
+        if action != "die" or event.get("Type", "container") != "container":
+            return
+        cid = event.get("id", event.get("Actor", {}).get("ID"))
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        code = attributes.get("exitCode")
+        t = event.get("timeNano", event.get("time", 0) * 1e9) / 1e9
+        state = deimos.state.State(self.root, docker_id=cid)
+        if not state.exists() or state.exit() is not None:
+            return
+        if code is None:
+            code = self.exit_code(deimos.docker.client(), cid)
+        state.exit(str(code))
+        log.info("exit %s // %s (%0.03fs after die)", code, cid,
+                 time.time() - t)
+
+    def reconcile(self, client):
+        "Write exit files for containers that died while unsubscribed."
+        for cid, _ in deimos.state.entries(self.root, "docker"):
+            state = deimos.state.State(self.root, docker_id=cid)
+            if state.exit() is not None:
+                continue
+            try:
+                info = client.inspect_container(cid, quiet=True)
+                if info["State"].get("Running"):
+                    continue
+                code = info["State"]["ExitCode"]
+            except deimos.engine.NotFound:
+                code = "unknown"
+            state.exit(str(code))
+            log.info("exit %s // %s (found while reconciling)", code, cid)
+
+    def exit_code(self, client, cid):
+        try:
+            info = client.inspect_container(cid, quiet=True)
+            return info["State"]["ExitCode"]
+        except deimos.engine.NotFound:        # Removed by `docker run --rm`
+            log.warning("No exit code in event or inspect for %s", cid)
+            return "unknown"
+
+
+def subscribed(root):
+    "Whether a subscriber is following the event stream for this root."
+    lk = deimos.flock.LK(lock_path(root), LOCK_SH | LOCK_NB)
+    try:
+        lk.lock()
+    except deimos.flock.Locked:
+        return True
+    lk.unlock()
+    return False
+
+
+def await_exit(state, check=5.0):
+    """
+    Block until the subscriber writes the container's exit file. Returns
+    False, without waiting, if no subscriber is running, and also if the
+    subscriber goes away; callers should then wait on Docker directly.
+    Returns True at once if the exit is already written: containers run
+    with --rm may be gone by the time the watcher gets here.
+    """
+    if state.exit() is not None:
+        return True
+    if not subscribed(state.root):
+        return False
+    try:                     # Catch exits from before the docker/ symlink
+        info = deimos.docker.client().inspect_container(state.cid())
+        if not info["State"].get("Running") and state.exit() is None:
+            state.exit(str(info["State"]["ExitCode"]))
+    except deimos.docker.failures():
+        return state.exit() is not None
+    start = time.time()
+    while state.await_exit(check) is None:
+        if not subscribed(state.root):
+            log.warning("Subscriber went away; waiting on Docker")
+            return False
+    t = state.mtime("exit")
+    log.info("exit %s // seen %0.03fs after it was written (%0.03fs wait)",
+             state.exit(), time.time() - t, time.time() - start)
+    return True
+
+
+def lock_path(root):
+    return os.path.join(os.path.abspath(root), "events")
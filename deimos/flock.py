@@ -1,9 +1,11 @@
-from contextlib import contextmanager
+import atexit
+import calendar
 import errno
 import fcntl
+import json
 import os
-import signal
-import subprocess
+import random
+import sys
 import time
 
 import deimos.err
@@ -11,60 +13,119 @@ from deimos.logger import log
 from deimos._struct import _Struct
 
 
-locks = {}
+locks = set()              # Handles holding locks, kept open while they do
 
 
 class LK(_Struct):
     default_timeout = 10
 
-    def __new__(cls, path, flags, seconds=default_timeout):
-        if os.path.abspath(path) in locks:
-            return locks[path]
-        else:
-            return super(LK, cls).__new__(cls, path, flags, seconds)
-
     def __init__(self, path, flags, seconds=default_timeout):
-        """Construct a lockable file handle. Handles are recycled.
+        """Construct a lockable file handle.
 
         If seconds is 0, LOCK_NB will be set. If LOCK_NB is set, seconds will
         be set to 0. If seconds is None, there will be no timeout; but flags
-        will not be adjusted in any way.
+        will not be adjusted in any way. Timeouts may be fractional; see
+        acquire().
+
+        Every handle opens the file anew when it locks, so that handles for
+        the same file contend with each other as they would in different
+        processes -- two threads can not both hold an exclusive lock -- and
+        one handle's unlock() leaves the others alone. While its lock is
+        held, a handle is kept in the registry, so the lock lasts even if
+        the caller drops the handle.
         """
-        full = os.path.abspath(path)
         flags, seconds = nb_seconds(flags, seconds)
-        if full not in locks:
-            _Struct.__init__(self, path=full,
-                                   handle=None,
-                                   fd=None,
-                                   flags=flags,
-                                   seconds=seconds)
-            locks[self.path] = self
+        _Struct.__init__(self, path=os.path.abspath(path),
+                               handle=None,
+                               fd=None,
+                               flags=flags,
+                               seconds=seconds,
+                               taken=None,
+                               on_unlock=None)
 
     def lock(self):
-        if self.handle is None or self.handle.closed:
-            self.handle = open(self.path, "w+")
+        if not self.held():
+            self.handle = reopen(self.path)
             self.fd = self.handle.fileno()
-        if (self.flags & fcntl.LOCK_NB) != 0 or self.seconds is None:
-            try:
-                fcntl.flock(self.handle, self.flags)
-            except IOError as e:
-                if e.errno not in [errno.EACCES, errno.EAGAIN]:
-                    raise e
-                raise Locked(self.path)
-        else:
-            with timeout(self.seconds):
+        try:
+            if (self.flags & fcntl.LOCK_NB) != 0 or self.seconds is None:
                 try:
                     fcntl.flock(self.handle, self.flags)
                 except IOError as e:
-                    errnos = [errno.EINTR, errno.EACCES, errno.EAGAIN]
-                    if e.errno not in errnos:
+                    if e.errno not in [errno.EACCES, errno.EAGAIN]:
                         raise e
-                    raise Timeout(self.path)
+                    raise Locked(self.path)
+            else:
+                acquire(self.handle, self.flags, self.seconds)
+        except BaseException:
+            if self.taken is None:         # Not held before, so not needed
+                self.handle.close()
+            raise
+        self.taken = time.time()
+        locks.add(self)
 
     def unlock(self):
-        if not self.handle.closed:
+        """
+        Release the lock, and pass the seconds it was held to the on_unlock
+        callback, if one is set. The callback is cleared.
+        """
+        if self.held():
             fcntl.flock(self.handle, fcntl.LOCK_UN)
             self.handle.close()
+            locks.discard(self)
+            on_unlock, self.on_unlock = self.on_unlock, None
+            taken, self.taken = self.taken, None
+            if on_unlock is not None and taken is not None:
+                on_unlock(time.time() - taken)
+
+    def stamp(self, data):
+        """
+        Replace the lock file's contents -- for example, with when the lock
+        was taken, for lock_browser(). Written straight to the descriptor,
+        so that other processes see it at once.
+        """
+        os.ftruncate(self.fd, 0)
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.write(self.fd, data)
+
+    def held(self):
+        "Whether the handle is open -- which it is while the lock is held."
+        return self.handle is not None and not self.handle.closed
+
+
+def reopen(path):
+    """
+    Open the lock file for reading and writing, creating it if need be but
+    never truncating it: the holder's stamp must survive contenders.
+    """
+    return os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0644), "r+")
+
+
+def dump():
+    """
+    The handles in the registry, which hold locks and so descriptors, with
+    the lock flags and how long each lock has been held; also logged, at
+    debug level, and by default when the process exits. Locks on files that
+    have since been removed -- which no one else can contend for, and which
+    are probably leaked -- are flagged and logged as warnings.
+    """
+    rows = []
+    for lk in sorted(locks, key=lambda lk: lk.path):
+        try:
+            removed = os.fstat(lk.fd).st_nlink == 0
+        except OSError:
+            removed = None
+        held = None if lk.taken is None else time.time() - lk.taken
+        rows += [dict(path=lk.path, fd=lk.fd, held=held, removed=removed,
+                      flags=format_lock_flags(lk.flags))]
+        line = "fd %d // %s %s (%s)" % (lk.fd, lk.path, rows[-1]["flags"],
+                                        "?" if held is None else
+                                        "%0.1fs" % held)
+        if removed:
+            log.warning("%s (file removed)", line)
+        else:
+            log.debug(line)
+    return rows
 
 
 def format_lock_flags(flags):
@@ -81,6 +142,34 @@ def nb_seconds(flags, seconds):
     return flags, seconds
 
 
+def acquire(handle, flags, seconds):
+    """
+    Take the lock on the open file, waiting for at most seconds, which may
+    be fractional. Rather than block in flock() until a signal interrupts
+    it, this polls with LOCK_NB, sleeping longer each time up to a limit --
+    with jitter, so that waiters who started together don't retry together
+    -- and never past the deadline. Signal handlers are left alone, so locks
+    can be taken this way from any thread, by many threads at once.
+    """
+    deadline = time.time() + seconds
+    sleep = backoff[0]
+    while True:
+        try:
+            fcntl.flock(handle, flags | fcntl.LOCK_NB)
+            return
+        except IOError as e:
+            if e.errno not in [errno.EACCES, errno.EAGAIN]:
+                raise e
+        left = deadline - time.time()
+        if left <= 0:
+            raise Timeout(handle.name)
+        time.sleep(min(left, random.uniform(sleep / 2, sleep)))
+        sleep = min(sleep * 2, backoff[1])
+
+# First and longest sleep between attempts to take a lock, in seconds.
+backoff = (0.001, 0.02)
+
+
 class Err(deimos.err.Err):
     pass
 
@@ -93,38 +182,168 @@ class Locked(Err):
     pass
 
 
-def lock_browser(directory):
-    bash = """
-        set -o errexit -o nounset -o pipefail
-
-        function files_by_inode {
-          find "$1" -type f -printf '%i %p\\n' | LC_ALL=C LANG=C sort
-        }
+def proc_locks(path="/proc/locks"):
+    """
+    The locks held on the system, as (kind, mode, pid, device, inode) tuples
+    -- for example ("FLOCK", "WRITE", 1234, 65024, 13534060) -- read from
+    /proc/locks in one pass. Requests still waiting for a lock are skipped.
+    Returns None if the lock table can't be read.
+    """
+    try:
+        with open(path) as h:
+            lines = h.read().splitlines()
+    except IOError:
+        return None
+    entries = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 6 or fields[1] == "->":       # Blocked, not holding
+            continue
+        try:
+            major, minor, inode = fields[5].split(":")
+            device = os.makedev(int(major, 16), int(minor, 16))
+            entries += [(fields[1], fields[3], int(fields[4]), device,
+                         int(inode))]
+        except ValueError:
+            continue
+    return entries
 
-        function locking_pids_by_inode {
-          cat /proc/locks |
-          sed -r '
-            s/^.+ ([^ ]+) +([0-9]+) [^ :]+:[^ :]+:([0-9]+) .+$/\\3 \\2 \\1/
-          ' | LC_ALL=C LANG=C sort
-        }
 
-        join <(locking_pids_by_inode) <(files_by_inode "$1")
+def held_exclusively():
+    """
+    The exclusive flock() entries of the lock table, by inode, for lookup
+    with held_on(); or None if the lock table can't be read.
     """
-    subprocess.check_call(["bash", "-c", bash, "bash",
-                           os.path.abspath(directory)])
+    entries = proc_locks()
+    if entries is None:
+        return None
+    return by_inode(entry for entry in entries
+                    if entry[0] == "FLOCK" and entry[1] == "WRITE")
 
-# Thanks to Glenn Maynard
-# http://stackoverflow.com/questions/5255220/fcntl-flock-how-to-implement-a-timeout/5255473#5255473
 
+def by_inode(entries):
+    "Lock table entries, as from proc_locks(), in lists by inode."
+    table = {}
+    for entry in entries:
+        table.setdefault(entry[4], []).append(entry)
+    return table
 
-@contextmanager
-def timeout(seconds):
-    def timeout_handler(signum, frame):
-        pass
-    original_handler = signal.signal(signal.SIGALRM, timeout_handler)
+
+def held_on(table, path, st=None):
+    """
+    The entries of the table, from by_inode(), for the lock file at path.
+    The lock table names files by the device number of their file system,
+    which on btrfs subvolumes and overlay differs from the st_dev stat()
+    reports; so entries are matched on the inode, and those on another
+    device are kept only if a non-blocking flock() on the file confirms
+    that it is locked.
+    """
+    if st is None:
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            if e.errno not in [errno.ENOENT, errno.ENOTDIR]:
+                raise e
+            return []
+    candidates = table.get(st.st_ino, [])
+    same = [entry for entry in candidates if entry[3] == st.st_dev]
+    if same or not candidates:
+        return same
+    exclusive = all(entry[1] == "WRITE" for entry in candidates)
+    return candidates if locked(path, exclusive) else []
+
+
+def locked(path, exclusive=False):
+    """
+    Whether some process holds a lock on the file that conflicts with a
+    shared lock (if exclusive, only an exclusive lock is asked about) or
+    with an exclusive one (any lock at all). Found by trying for the lock
+    without blocking, and letting it go at once if it is granted.
+    """
+    flags = fcntl.LOCK_SH if exclusive else fcntl.LOCK_EX
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:                                  # Removed meanwhile
+        return False
     try:
-        signal.alarm(seconds)
-        yield
+        fcntl.flock(fd, flags | fcntl.LOCK_NB)
+        return False
+    except IOError as e:
+        if e.errno not in [errno.EAGAIN, errno.EACCES]:
+            raise e
+        return True
     finally:
-        signal.alarm(0)
-        signal.signal(signal.SIGALRM, original_handler)
+        os.close(fd)                               # Releases the lock, too
+
+
+def lock_browser(directory, fmt="table", out=sys.stdout):
+    """
+    List the locks held on files under the directory: for each, the path,
+    the lock mode, the holding PID and what it is running (for Deimos, the
+    subcommand), and for exclusive locks, how long the lock has been held,
+    from the timestamp written into the file when it was taken. Writes a
+    table, or with fmt="json", a JSON list.
+    """
+    rows = held_under(directory)
+    if fmt == "json":
+        json.dump(rows, out, indent=2, sort_keys=True)
+        out.write("\n")
+        return
+    line = "%-6s %-4s %7s %-18s %9s  %s\n"
+    out.write(line % ("kind", "mode", "pid", "holder", "held", "path"))
+    for row in rows:
+        held = "-" if row["held"] is None else "%0.1fs" % row["held"]
+        out.write(line % (row["kind"], row["mode"], row["pid"],
+                          row["holder"], held, row["path"]))
+
+
+def held_under(directory):
+    "Locks held on files in lock/ directories under the directory."
+    entries = proc_locks()
+    if entries is None:
+        raise Err("Not able to read /proc/locks")
+    table = by_inode(entries)
+    rows = []
+    for parent, _, names in os.walk(os.path.abspath(directory)):
+        if os.path.basename(parent) != "lock":
+            continue
+        for name in names:
+            path = os.path.join(parent, name)
+            try:
+                st = os.lstat(path)
+            except OSError:                          # Removed meanwhile
+                continue
+            for kind, mode, pid, _, _ in held_on(table, path, st):
+                exclusive = mode == "WRITE"
+                rows += [dict(path=path, kind=kind, pid=pid,
+                              mode="EX" if exclusive else "SH",
+                              holder=holder(pid),
+                              held=held_since(path) if exclusive else None)]
+    return sorted(rows, key=lambda row: (row["path"], row["pid"]))
+
+
+def holder(pid):
+    "The Deimos subcommand the process is running, or its command name."
+    try:
+        with open("/proc/%d/cmdline" % pid) as h:
+            argv = h.read().split("\0")[:-1]
+    except IOError:
+        return "?"
+    for i, arg in enumerate(argv):
+        if os.path.basename(arg) == "deimos" or arg == "deimos.__init__":
+            rest = argv[i + 1:]
+            return "deimos " + (rest[0] if rest else "")
+    return os.path.basename(argv[0]) if argv else "?"
+
+
+def held_since(path):
+    "Seconds since the timestamp in the lock file, or None."
+    try:
+        with open(path) as h:
+            stamp = h.read().strip()
+        t = calendar.timegm(time.strptime(stamp[:19], "%Y-%m-%dT%H:%M:%S"))
+        return time.time() - (t + float(stamp[19:-1] or 0))
+    except (IOError, ValueError):
+        return None
+
+atexit.register(dump)     # Locks still held at exit, in the debug log
@@ -0,0 +1,118 @@
+import errno
+import hashlib
+import json
+import os
+import time
+
+from deimos.logger import log
+from deimos._struct import _Struct
+
+
+class Cache(_Struct):
+
+    """
+    Image inspect results, shared by all Deimos processes through one file
+    per image reference and kind of result (the local image's, or the
+    registry's). References are compared with the default tag filled in, so
+    ubuntu and ubuntu:latest share entries. Entries are trusted for ttl
+    seconds after they were last checked against Docker; after that, get()
+    misses and the caller is expected to inspect the image again and put()
+    the result, which records whether the reference now names a different
+    image ID. Pulling may move the reference sooner, so pulls invalidate()
+    its entries first.
+
+    Files are replaced atomically, so concurrent launches never see partial
+    entries; reads touch the file, and writes evict the least recently used
+    entries beyond the size bound.
+    """
+
+    def __init__(self, directory, size=256, ttl=300):
+        _Struct.__init__(self, directory=os.path.abspath(directory),
+                               size=size,
+                               ttl=ttl)
+
+    def get(self, image, kind="local"):
+        path = self.path(image, kind)
+        try:
+            with open(path) as h:
+                entry = json.load(h)
+        except (IOError, ValueError):
+            return None
+        if entry.get("image") != key(image, kind):
+            return None
+        if time.time() - entry.get("checked", 0) > self.ttl:
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return entry["info"]
+
+    def put(self, image, info, kind="local"):
+        path = self.path(image, kind)
+        previous = self.entry_id(path)
+        if previous is not None and previous != info.get("Id"):
+            log.info("%s is now %s (was %s)", image, info.get("Id"), previous)
+        entry = {"image": key(image, kind), "id": info.get("Id"),
+                 "checked": time.time(), "info": info}
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise e
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as h:
+            json.dump(entry, h, separators=(",", ":"))
+        os.rename(tmp, path)
+        self.evict()
+
+    def drop(self, image, kind="local"):
+        try:
+            os.unlink(self.path(image, kind))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise e
+
+    def invalidate(self, image):
+        "Drop every kind of entry for the image."
+        for kind in kinds:
+            self.drop(image, kind)
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                p = os.path.join(self.directory, name)
+                entries += [(os.stat(p).st_mtime, p)]
+            except OSError:          # Evicted by another process meanwhile
+                continue
+        for _, p in sorted(entries)[:max(0, len(entries) - self.size)]:
+            try:
+                os.unlink(p)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise e
+
+    def entry_id(self, path):
+        try:
+            with open(path) as h:
+                return json.load(h).get("id")
+        except (IOError, ValueError):
+            return None
+
+    def path(self, image, kind="local"):
+        name = hashlib.sha1(key(image, kind)).hexdigest() + ".json"
+        return os.path.join(self.directory, name)
+
+
+def key(image, kind):
+    "The image reference with the default tag, if it has no tag or digest."
+    last = image.rsplit("/", 1)[-1]
+    if "@" not in last and ":" not in last:
+        image += ":latest"
+    return "%s %s" % (kind, image)
+
+kinds = ["local", "registry"]
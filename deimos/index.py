@@ -0,0 +1,125 @@
+import os
+import sqlite3
+import threading
+
+from deimos.logger import log
+from deimos._struct import _Struct
+
+
+schema = """
+CREATE TABLE IF NOT EXISTS containers (
+    mesos_id  TEXT PRIMARY KEY,
+    docker_id TEXT,
+    start     TEXT,
+    exit      TEXT
+);
+CREATE INDEX IF NOT EXISTS by_docker_id ON containers (docker_id);
+CREATE INDEX IF NOT EXISTS by_exit_start ON containers (exit, start);
+CREATE INDEX IF NOT EXISTS by_start ON containers (start);
+"""
+
+
+class Index(_Struct):
+
+    """
+    A SQLite database of the containers under a state root -- their Docker
+    IDs, start times and exit codes -- so that listing running or exited
+    containers doesn't mean walking the state directories. The directories
+    remain authoritative: every change is written there first, and the
+    index can be rebuilt from them at any time.
+
+    Each thread of each process opens the database once and keeps the
+    connection; the schema is created, and WAL mode set, only when the
+    database is new (see connect()).
+    """
+
+    def __init__(self, root="/tmp/deimos"):
+        _Struct.__init__(self, root=os.path.abspath(root),
+                               path=os.path.join(root, "index.sqlite"),
+                               local=threading.local())
+
+    def connect(self):
+        """
+        This thread's connection, opened on first use and again after a
+        fork: SQLite connections must not be used across one, so the
+        inherited connection is kept, unused, rather than closed.
+        """
+        pid, conn = getattr(self.local, "connection", (None, None))
+        if pid == os.getpid():
+            return conn
+        if conn is not None:
+            inherited.append(conn)
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        conn = sqlite3.connect(self.path, timeout=30)
+        if conn.execute("PRAGMA user_version").fetchone()[0] < version:
+            conn.execute("PRAGMA journal_mode=WAL")  # Readers don't block
+            conn.executescript(schema)               # writers; kept in the
+            conn.execute("PRAGMA user_version = %d" % version)        # file
+        self.local.connection = (os.getpid(), conn)
+        return conn
+
+    def record(self, mesos_id, docker_id=None, start=None, exit=None):
+        "Add the container, or fill in fields that are not None."
+        with self.connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO containers (mesos_id) "
+                         "VALUES (?)", (mesos_id,))
+            conn.execute("UPDATE containers SET "
+                         "docker_id = COALESCE(?, docker_id), "
+                         "start = COALESCE(?, start), "
+                         "exit = COALESCE(?, exit) WHERE mesos_id = ?",
+                         (docker_id, start, exit, mesos_id))
+
+    def remove(self, mesos_ids):
+        with self.connect() as conn:
+            conn.executemany("DELETE FROM containers WHERE mesos_id = ?",
+                             [(mesos_id,) for mesos_id in mesos_ids])
+
+    def running(self):
+        "Pairs of Docker and Mesos ID for containers with no exit code."
+        return self.query("SELECT docker_id, mesos_id FROM containers "
+                          "WHERE exit IS NULL AND docker_id IS NOT NULL")
+
+    def started_before(self, timestamp, exited=None):
+        """
+        Start times of the containers started before the ISO 8601 timestamp;
+        only those with an exit code if exited is True, only those without
+        if it is False.
+        """
+        sql = "SELECT start FROM containers WHERE start < ?"
+        if exited is not None:
+            sql += " AND exit IS NOT NULL" if exited else " AND exit IS NULL"
+        return [start for start, in self.query(sql + " ORDER BY start",
+                                               timestamp)]
+
+    def mesos_id(self, docker_id):
+        rows = self.query("SELECT mesos_id FROM containers "
+                          "WHERE docker_id = ?", docker_id)
+        return rows[0][0] if rows else None
+
+    def query(self, sql, *args):
+        return [tuple(str(v) if v is not None else None for v in row)
+                for row in self.connect().execute(sql, args)]
+
+    def rebuild(self):
+        "Replace the index with what the state directories record."
+        import deimos.state
+        rows = []
+        for mesos_id, _ in deimos.state.entries(self.root, "mesos"):
+            state = deimos.state.State(self.root, mesos_id=mesos_id)
+            exit = state._readf("exit")
+            rows += [(mesos_id, state.cid(), state.t(), exit)]
+        with self.connect() as conn:
+            conn.execute("DELETE FROM containers")
+            conn.executemany("INSERT INTO containers "
+                             "(mesos_id, docker_id, start, exit) "
+                             "VALUES (?, ?, ?, ?)", rows)
+        log.info("Indexed %d containers", len(rows))
+        return len(rows)
+
+
+failures = (sqlite3.Error, OSError)
+
+inherited = []              # Connections opened before a fork; see connect()
+
+version = 1                 # Of the schema, kept in PRAGMA user_version
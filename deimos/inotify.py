@@ -0,0 +1,90 @@
+import ctypes
+import errno
+import itertools
+import os
+import select
+import time
+
+import deimos.libc
+from deimos.logger import log
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# Writes through open/write/close and through rename both show up.
+mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+
+def wait_for(path, check, seconds=None, sleeps=None):
+    """
+    Call check() until it returns something other than None, and return
+    that; or return None once seconds have passed. Between calls, waits for
+    a file to be written or moved into the directory containing path, using
+    inotify; where inotify is not available, sleeps for each of the intervals
+    from sleeps in turn (by default, a tenth of a second).
+    """
+    start = time.time()
+    fd = watch(os.path.dirname(path))
+    if fd is None:
+        sleeps = sleeps if sleeps is not None else itertools.repeat(0.1)
+    try:
+        while True:
+            result = check()
+            if result is not None:
+                return result
+            left = None if seconds is None else seconds - (time.time() - start)
+            if left is not None and left <= 0:
+                return None
+            if fd is None:
+                time.sleep(next(sleeps) if left is None
+                           else min(next(sleeps), left))
+            else:
+                # Recheck now and then anyway, in case of a missed event.
+                wait(fd, recheck if left is None else min(recheck, left))
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+def watch(directory):
+    "An inotify descriptor watching the directory, or None."
+    global libc
+    if libc is False:
+        libc = deimos.libc.load("inotify_init1", "inotify_add_watch")
+    if libc is None or not os.path.isdir(directory):
+        return None
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        log.debug("inotify_init1: %s", os.strerror(ctypes.get_errno()))
+        return None
+    if libc.inotify_add_watch(fd, directory, mask) < 0:
+        log.debug("inotify_add_watch: %s", os.strerror(ctypes.get_errno()))
+        os.close(fd)
+        return None
+    return fd
+
+
+def wait(fd, seconds):
+    try:
+        readable, _, _ = select.select([fd], [], [], seconds)
+    except select.error as e:
+        if e.args[0] != errno.EINTR:
+            raise e
+        return
+    if readable:
+        try:
+            while os.read(fd, 4096):           # Drain; check() decides
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise e
+
+
+libc = False                                       # Loaded on first use
+
+recheck = 5.0
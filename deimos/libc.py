@@ -0,0 +1,18 @@
+import ctypes
+import ctypes.util
+
+
+def load(*symbols):
+    """
+    The C library, loaded so that ctypes.get_errno() works after calls into
+    it, or None if it can't be found or lacks any of the named functions.
+    """
+    for find in [lambda: "libc.so.6", lambda: ctypes.util.find_library("c")]:
+        try:
+            lib = ctypes.CDLL(find(), use_errno=True)
+            for symbol in symbols:
+                getattr(lib, symbol)
+            return lib
+        except (OSError, AttributeError, TypeError):
+            continue
+    return None
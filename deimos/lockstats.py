@@ -0,0 +1,116 @@
+import fcntl
+import json
+import os
+import sys
+import time
+
+from deimos.logger import log
+
+
+def record(root, kind, name, mode, seconds, container):
+    """
+    Append a measurement to the metrics file under the root: how long a
+    lock was waited for ("wait"), waited for in vain ("fail"), or held
+    ("hold"). Each is a line of text written with a single append, so
+    concurrent processes don't interleave; once the file reaches the size
+    limit, it is moved aside to make room, replacing the one before. Only
+    one writer moves it: the others find, under a lock on the file, that
+    the path now names a new one. Failures are logged and otherwise
+    ignored -- metrics never stand in the way of locking.
+    """
+    line = "%0.3f %s %s %s %0.6f %s\n" % (time.time(), kind, name, mode,
+                                          seconds, container or "-")
+    path = os.path.join(root, "lockstats")
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, line)
+            if os.fstat(fd).st_size > limit:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                    os.rename(path, path + ".1")
+        finally:
+            os.close(fd)                           # Releases the lock, too
+    except (IOError, OSError) as e:
+        log.debug("Not able to record lock metrics: %s", e)
+
+
+def read(root, since=0):
+    "Measurements from the metrics files, as dicts, from since onwards."
+    rows = []
+    path = os.path.join(root, "lockstats")
+    for p in [path + ".1", path]:
+        try:
+            with open(p) as h:
+                lines = h.read().splitlines()
+        except IOError:
+            continue
+        for line in lines:
+            fields = line.split(" ")
+            try:
+                t, seconds = float(fields[0]), float(fields[4])
+            except (IndexError, ValueError):        # Cut short by a crash
+                continue
+            if t >= since and len(fields) == 6:
+                rows += [dict(t=t, kind=fields[1], name=fields[2],
+                              mode=fields[3], seconds=seconds,
+                              container=fields[5])]
+    return rows
+
+
+def summarize(rows):
+    """
+    Per lock name and mode, the number of locks taken and of timeouts, and
+    percentiles of the time spent waiting for and holding the lock.
+    """
+    groups = {}
+    for row in rows:
+        group = groups.setdefault("%s %s" % (row["name"], row["mode"]),
+                                  dict(wait=[], hold=[], fail=[]))
+        group.get(row["kind"], []).append(row["seconds"])
+    summary = {}
+    for key, group in groups.items():
+        summary[key] = dict(taken=len(group["wait"]),
+                            failed=len(group["fail"]),
+                            wait=percentiles(group["wait"]),
+                            hold=percentiles(group["hold"]))
+    return summary
+
+
+def percentiles(samples):
+    if len(samples) == 0:
+        return None
+    ordered = sorted(samples)
+
+    def pick(p):
+        return ordered[min(int(p * len(ordered)), len(ordered) - 1)]
+    return dict(p50=pick(0.50), p95=pick(0.95), p99=pick(0.99),
+                max=ordered[-1])
+
+
+def report(root, window=3600, fmt="table", out=sys.stdout):
+    "Write a summary of the last window seconds of lock metrics."
+    summary = summarize(read(root, time.time() - window))
+    if fmt == "json":
+        json.dump(summary, out, indent=2, sort_keys=True)
+        out.write("\n")
+        return
+    line = "%-12s %6s %6s" + " %9s" * 6 + "\n"
+    out.write(line % ("lock", "taken", "failed", "wait p50", "p95", "p99",
+                      "hold p50", "p95", "p99"))
+    for key in sorted(summary):
+        s = summary[key]
+        cells = []
+        for kind in ["wait", "hold"]:
+            cells += [ms(s[kind], p) for p in ["p50", "p95", "p99"]]
+        out.write(line % tuple([key, s["taken"], s["failed"]] + cells))
+    out.write("(milliseconds, over the last %gs)\n" % window)
+
+
+def ms(stats, p):
+    return "-" if stats is None else "%0.2f" % (stats[p] * 1000)
+
+
+# Global settings
+
+limit = 4 << 20    # Bytes in the metrics file before it is moved aside
@@ -1,7 +1,7 @@
-import inspect
 import logging
 import logging.handlers
 import os
+import sys
 
 
 root = logging.getLogger("deimos")
@@ -11,31 +11,38 @@ class log():  # Really just a namespace
 
     @staticmethod
     def debug(*args, **opts):
-        logger(2).debug(*args, **opts)
+        if root.isEnabledFor(logging.DEBUG):
+            logger(2).debug(*args, **opts)
 
     @staticmethod
     def info(*args, **opts):
-        logger(2).info(*args, **opts)
+        if root.isEnabledFor(logging.INFO):
+            logger(2).info(*args, **opts)
 
     @staticmethod
     def warning(*args, **opts):
-        logger(2).warning(*args, **opts)
+        if root.isEnabledFor(logging.WARNING):
+            logger(2).warning(*args, **opts)
 
     @staticmethod
     def error(*args, **opts):
-        logger(2).error(*args, **opts)
+        if root.isEnabledFor(logging.ERROR):
+            logger(2).error(*args, **opts)
 
     @staticmethod
     def critical(*args, **opts):
-        logger(2).critical(*args, **opts)
+        if root.isEnabledFor(logging.CRITICAL):
+            logger(2).critical(*args, **opts)
 
     @staticmethod
     def exception(*args, **opts):
-        logger(2).exception(*args, **opts)
+        if root.isEnabledFor(logging.ERROR):
+            logger(2).exception(*args, **opts)
 
     @staticmethod
-    def log(*args, **opts):
-        logger(2).log(*args, **opts)
+    def log(level, *args, **opts):
+        if root.isEnabledFor(level):
+            logger(2).log(level, *args, **opts)
 
 
 def initialize(console=logging.DEBUG, syslog=logging.INFO):
@@ -64,18 +71,27 @@ def initialize(console=logging.DEBUG, syslog=logging.INFO):
 
 def logger(height=1):                 # http://stackoverflow.com/a/900404/48251
     """
-    Obtain a function logger for the calling function. Uses the inspect module
-    to find the name of the calling function and its position in the module
-    hierarchy. With the optional height argument, logs for caller's caller, and
-    so forth.
+    Obtain a function logger for the calling function. Walks up the stack to
+    find the calling function and its position in the module hierarchy. With
+    the optional height argument, logs for caller's caller, and so forth.
+
+    Loggers are memoized by code object, so after the first call from a given
+    function, lookup costs a frame walk and a dictionary access.
     """
-    caller = inspect.stack()[height]
-    scope = caller[0].f_globals
-    function = caller[3]
-    path = scope["__name__"]
-    if path == "__main__" and scope["__package__"]:
-        path = scope["__package__"]
-    return logging.getLogger(path + "." + function + "()")
+    frame = sys._getframe(height)
+    code = frame.f_code
+    try:
+        return _loggers[code]
+    except KeyError:
+        scope = frame.f_globals
+        path = scope["__name__"]
+        if path == "__main__" and scope["__package__"]:
+            path = scope["__package__"]
+        found = logging.getLogger(path + "." + code.co_name + "()")
+        _loggers[code] = found
+        return found
+
+_loggers = {}
 
 _initialized = False
 
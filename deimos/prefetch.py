@@ -0,0 +1,62 @@
+import Queue
+import threading
+import time
+
+import deimos.docker
+from deimos.logger import log
+
+
+def prefetch(images, parallel=4):
+    """
+    Pull the images, at most parallel at a time, through deimos.docker.pull()
+    so that the image cache is refreshed as well. Returns the images that
+    could not be pulled.
+    """
+    queue, seen = Queue.Queue(), set()
+    for image in images:
+        if image not in seen:
+            queue.put(image)
+            seen.add(image)
+    failed = []
+
+    def worker():
+        while True:
+            try:
+                image = queue.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            try:
+                info = deimos.docker.pull(image)
+                if info is None:
+                    log.warning("Pulled %s but can not inspect it", image)
+            except deimos.docker.failures() as e:
+                log.warning("Failed to pull %s: %s", image, e)
+                info = None
+            if info is None:
+                failed.append(image)
+                continue
+            log.info("Pulled %s in %0.03fs", image, time.time() - start)
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(parallel, len(seen))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():           # Joining with a timeout leaves the
+            thread.join(0.5)               # main thread able to take signals
+    return failed
+
+
+def watch(images, parallel=4, interval=3600):
+    """
+    Prefetch the images every interval seconds, forever. Pulling a tag that
+    is already present fetches it again if it has moved, so moving tags like
+    latest are kept current.
+    """
+    while True:
+        start = time.time()
+        failed = prefetch(images, parallel)
+        log.info("Prefetched %d of %d images in %0.03fs",
+                 len(images) - len(failed), len(images), time.time() - start)
+        time.sleep(max(0, interval - (time.time() - start)))
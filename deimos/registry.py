@@ -0,0 +1,180 @@
+import httplib
+import json
+import os
+import re
+import socket
+import urllib
+import urlparse
+
+import deimos.err
+from deimos.logger import log
+
+
+manifest_types = ["application/vnd.docker.distribution.manifest.v2+json",
+                  "application/vnd.docker.distribution.manifest.list.v2+json",
+                  "application/vnd.oci.image.manifest.v1+json",
+                  "application/vnd.oci.image.index.v1+json",
+                  "application/vnd.docker.distribution.manifest.v1+json"]
+
+
+def inspect(image, timeout=10):
+    """
+    Fetch an image's configuration from its registry, with the manifest and
+    the config blob only, so the layers are not downloaded. Returns a dict
+    shaped like the relevant part of `docker inspect` -- with the config
+    digest as "Id" and the container config as "Config" -- or None if the
+    registry can not be reached or doesn't have the image.
+    """
+    try:
+        return Registry(image, timeout).inspect()
+    except (Err, httplib.HTTPException, socket.error, ValueError,
+            KeyError) as e:
+        log.info("Not able to read %s from its registry: %s", image, e)
+        return None
+
+
+class Registry(object):
+
+    def __init__(self, image, timeout=10):
+        self.host, self.name, self.reference = parse(image)
+        self.timeout = timeout
+        self.authorization = None
+
+    def inspect(self):
+        manifest = self.manifest(self.reference)
+        if "manifests" in manifest:                      # A list or index
+            manifest = self.manifest(pick_platform(manifest["manifests"]))
+        if manifest.get("schemaVersion") == 1:
+            history = json.loads(manifest["history"][0]["v1Compatibility"])
+            return {"Id": history.get("id"), "Config": history["config"]}
+        digest = manifest["config"]["digest"]
+        blob = json.loads(self.get("/v2/%s/blobs/%s" % (self.name, digest)))
+        return {"Id": digest, "Config": blob.get("config", {})}
+
+    def manifest(self, reference):
+        path = "/v2/%s/manifests/%s" % (self.name, reference)
+        accept = {"Accept": ", ".join(manifest_types)}
+        return json.loads(self.get(path, accept))
+
+    def get(self, path, headers={}, redirects=5):
+        url = "%s://%s%s" % (scheme(self.host), self.host, path)
+        for _ in range(redirects + 1):
+            status, response_headers, data = self.fetch(url, headers)
+            if status == 401 and self.authorization is None:
+                challenge = response_headers.get("www-authenticate", "")
+                self.authorization = self.authenticate(challenge)
+                status, response_headers, data = self.fetch(url, headers)
+            if status in [301, 302, 303, 307, 308]:
+                url = urlparse.urljoin(url, response_headers["location"])
+                continue
+            if status != 200:
+                raise Err("GET %s: %d" % (url, status))
+            return data
+        raise Err("Too many redirects for %s" % path)
+
+    def fetch(self, url, headers):
+        parsed = urlparse.urlparse(url)
+        https = parsed.scheme == "https"
+        cls = httplib.HTTPSConnection if https else httplib.HTTPConnection
+        conn = cls(parsed.netloc, timeout=self.timeout)
+        headers = dict(headers)
+        if self.authorization is not None and parsed.netloc == self.host:
+            headers["Authorization"] = self.authorization
+        path = parsed.path + ("?" + parsed.query if parsed.query else "")
+        log.debug("call // GET %s", url)
+        try:
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        finally:
+            conn.close()
+        log.debug("exit %d // GET %s", response.status, url)
+        response_headers = dict((k.lower(), v)
+                                for k, v in response.getheaders())
+        return response.status, response_headers, data
+
+    def authenticate(self, challenge):
+        """
+        Answer a registry's authentication challenge: basic authentication
+        with credentials from a dockercfg, or a bearer token from the token
+        service named in the challenge (anonymous, if there are none).
+        """
+        basic = credentials(self.host)
+        kind, _, params = challenge.partition(" ")
+        if kind.lower() == "basic":
+            if basic is None:
+                raise Err("No credentials for %s" % self.host)
+            return "Basic " + basic
+        if kind.lower() != "bearer":
+            raise Err("Unsupported authentication: %r" % challenge)
+        fields = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        query = dict((k, v) for k, v in fields.items() if k != "realm")
+        url = fields["realm"] + "?" + urllib.urlencode(query)
+        headers = {"Authorization": "Basic " + basic} if basic else {}
+        status, _, data = self.fetch(url, headers)
+        if status != 200:
+            raise Err("Token service %s: %d" % (fields["realm"], status))
+        token = json.loads(data)
+        token = token.get("token", token.get("access_token"))
+        if token is None:
+            raise Err("No token from token service %s" % fields["realm"])
+        return "Bearer " + token
+
+
+def parse(image):
+    """
+    Split an image reference into registry host, repository name and tag or
+    digest, filling in Docker's defaults.
+    """
+    host, name = "registry-1.docker.io", image
+    first, _, rest = image.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        host, name = first, rest
+    if "@" in name:
+        name, reference = name.split("@", 1)
+    elif ":" in name:
+        name, reference = name.rsplit(":", 1)
+    else:
+        reference = "latest"
+    if host == "registry-1.docker.io" and "/" not in name:
+        name = "library/" + name
+    return host, name, reference
+
+
+def scheme(host):
+    local = host.split(":")[0] in ["localhost", "127.0.0.1"]
+    return "http" if local else "https"
+
+
+def pick_platform(manifests):
+    machine = os.uname()[4]
+    arch = {"x86_64": "amd64", "aarch64": "arm64"}.get(machine, machine)
+    for m in manifests:
+        platform = m.get("platform", {})
+        linux = platform.get("os", "linux") == "linux"
+        if linux and platform.get("architecture") == arch:
+            return m["digest"]
+    return manifests[0]["digest"]
+
+
+def credentials(host):
+    "Base64 user:password for the registry, from the usual dockercfg files."
+    paths = [".dockercfg", os.path.expanduser("~/.dockercfg"),
+             os.path.expanduser("~/.docker/config.json")]
+    for path in paths:
+        try:
+            with open(path) as h:
+                cfg = json.load(h)
+        except (IOError, ValueError):
+            continue
+        auths = cfg.get("auths", cfg)
+        for key, entry in auths.items():
+            key_host = urlparse.urlparse(key).netloc or key.split("/")[0]
+            hub = host == "registry-1.docker.io" and "docker.io" in key_host
+            if (key_host == host or hub) and "auth" in entry:
+                return entry["auth"]
+    return None
+
+
+class Err(deimos.err.Err):
+    pass
@@ -0,0 +1,440 @@
+from base64 import b64decode, b64encode
+import errno
+import json
+import os
+import select
+import signal
+import socket
+from StringIO import StringIO
+import struct
+import sys
+import time
+
+import deimos.err
+from deimos.logger import log
+import deimos.sig
+from deimos._struct import _Struct
+
+
+class Server(_Struct):
+
+    """
+    A resident Deimos process, listening on a UNIX socket.
+
+    The server loads the configuration, the Protobuf modules and the
+    containerizer once; each request is then handled in a forked child, which
+    inherits all of that and runs the subcommand exactly as the command line
+    would have. Children are forked because the containerizer methods change
+    directory, install signal handlers and, in the case of launch, fork
+    watchers of their own.
+
+    Calls to wait are the exception, while their container is running: they
+    are parked in the server itself (see Waiters) and only handed to a child
+    once the container exits.
+    """
+
+    def __init__(self, path, containerizer, dispatch):
+        root = getattr(containerizer, "state_root", None)
+        _Struct.__init__(self, path=os.path.abspath(path),
+                               containerizer=containerizer,
+                               dispatch=dispatch,
+                               listener=None,
+                               pending={},      # Conn: [data so far, due]
+                               waiters=Waiters(root) if root else None)
+
+    def serve(self):
+        self.bind()
+        deimos.sig.install(self.stop)
+        log.info("Listening on %s", self.path)
+        while True:
+            reap()
+            fds = [self.listener] + self.pending.keys()
+            if self.waiters is not None:
+                fds += self.waiters.fds()
+            try:
+                readable, _, _ = select.select(fds, [], [], 1.0)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise e
+                continue
+            if self.waiters is not None:
+                for call in self.waiters.ready(readable):
+                    self.fork(*call)
+            for conn in [c for c in readable if c in self.pending]:
+                call = self.receive(conn)
+                if call is None:
+                    continue
+                if self.waiters is None or not self.waiters.park(*call):
+                    self.fork(*call)
+            self.expire()
+            if self.listener not in readable:
+                continue
+            try:
+                conn, _ = self.listener.accept()
+            except socket.error as e:
+                if e.errno not in [errno.EINTR, errno.EAGAIN]:
+                    raise e
+                continue
+            conn.setblocking(0)
+            self.pending[conn] = ["", time.time() + receive_timeout]
+
+    def fork(self, conn, request, payload):
+        pid = os.fork()
+        if pid == 0:
+            code = 8
+            try:
+                self.listener.close()
+                for pending in self.pending:
+                    pending.close()
+                if self.waiters is not None:
+                    self.waiters.close()
+                code = self.handle(conn, request, payload)
+            except Exception:
+                log.exception("Failure while handling request")
+            finally:
+                os._exit(code)
+        conn.close()
+
+    def receive(self, conn):
+        """
+        Read what the client has sent so far, without blocking; once it has
+        sent both the request and the payload, return them with the
+        connection. Until then, or if the client hangs up or sends something
+        unreadable, return None. Requests are read here in the server, as
+        select() finds them readable, so that no client -- however slow --
+        holds up the others.
+        """
+        try:
+            chunk = conn.recv(65536)
+        except socket.error as e:
+            if e.errno in [errno.EAGAIN, errno.EINTR]:
+                return None
+            log.warning("Not able to read request: %s", e)
+            chunk = None
+        if not chunk:
+            if chunk == "":
+                log.warning("Client hung up before sending a request")
+            del self.pending[conn]
+            conn.close()
+            return None
+        self.pending[conn][0] += chunk
+        parts = frames(self.pending[conn][0], 2)
+        if parts is None:
+            return None
+        del self.pending[conn]
+        conn.setblocking(1)
+        try:
+            return conn, decode_request(parts[0]), parts[1]
+        except (ValueError, TypeError, KeyError) as e:
+            log.warning("Not able to read request: %s", e)
+            conn.close()
+            return None
+
+    def expire(self):
+        "Hang up on clients that have taken too long to send a request."
+        now = time.time()
+        for conn, (_, due) in self.pending.items():
+            if due < now:
+                log.warning("No request after %gs; hanging up",
+                            receive_timeout)
+                del self.pending[conn]
+                conn.close()
+
+    def bind(self):
+        if os.path.exists(self.path):
+            if alive(self.path):
+                raise Err("Server already listening on %s" % self.path)
+            os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        os.chmod(self.path, 0600)
+        self.listener.listen(128)
+
+    def stop(self, signum):
+        log.info("Shutting down; removing %s", self.path)
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        if self.waiters is not None:        # Let them wait the usual way
+            for call in self.waiters.release():
+                self.fork(*call)
+        return 0
+
+    def handle(self, conn, request, payload):
+        deimos.sig.install(lambda _: None)
+        send(conn, json.dumps({"pid": os.getpid()}))
+        os.environ.clear()
+        os.environ.update(request["env"])
+        os.chdir(request["cwd"])
+        sys.argv = [sys.argv[0]] + request["argv"]
+        sys.stdin, sys.stdout = StringIO(payload), StringIO()
+        pid = os.getpid()
+        code = self.dispatch(self.containerizer, sys.argv)
+        if os.getpid() != pid:      # A watcher forked by launch(); it exits
+            return code             # without replying, like on the CLI.
+        send(conn, json.dumps({"code": code}))
+        send(conn, sys.stdout.getvalue())
+        conn.shutdown(socket.SHUT_RDWR)  # Watchers may still hold the socket
+        conn.close()
+        return code
+
+
+class Waiters(_Struct):
+
+    """
+    Calls to wait, parked in the server until their container exits, where
+    each would otherwise be a process of its own blocked on the wait lock.
+    All the calls for a container share one subscription to its exit file
+    (see State.subscribe()); once the exit is written, they wake together
+    and are handed to forked children, which run wait as usual -- without
+    blocking for long, by then. A parked call costs the server its socket
+    and a few small objects.
+
+    Only calls for containers whose launch has finished, and whose watcher
+    holds the wait lock, are parked. Every few seconds, the lock table is
+    checked, so that calls parked on a watcher that died without writing
+    the exit file are not left waiting for it.
+    """
+
+    def __init__(self, root):
+        _Struct.__init__(self, root=root,
+                               containers={},   # Mesos ID: [fd, state, calls]
+                               checked=time.time())
+
+    def park(self, conn, request, payload):
+        "Park the call, if it is a wait that would block; or return False."
+        from deimos.containerizer import containerizer_pb2
+        from deimos.flock import held_exclusively
+        from deimos.state import State
+        if request["argv"][:1] != ["wait"]:
+            return False
+        try:
+            wait_pb = containerizer_pb2().Wait()
+            wait_pb.ParseFromString(payload[4:])
+            mesos_id = wait_pb.container_id.value
+        except Exception as e:
+            log.warning("Not able to read wait request: %s", e)
+            return False
+        if mesos_id not in self.containers:
+            table = held_exclusively()
+            state = State(self.root, mesos_id=mesos_id)
+            if table is None or not state.held("wait", table):
+                return False
+            fd = state.subscribe("exit")
+            if fd is None:
+                return False
+            if state.exit() is not None:
+                os.close(fd)
+                return False
+            self.containers[mesos_id] = [fd, state, []]
+        self.containers[mesos_id][2] += [(conn, request, payload)]
+        log.info("Parked wait for %s (%d waiting)",
+                 mesos_id, len(self.containers[mesos_id][2]))
+        return True
+
+    def fds(self):
+        fds = []
+        for fd, _, calls in self.containers.values():
+            fds += [fd] + [conn for conn, _, _ in calls]
+        return fds
+
+    def ready(self, readable):
+        """
+        The calls to run now, given the descriptors select() found readable:
+        those for containers that have exited or whose watchers are gone.
+        Calls whose clients hung up are dropped.
+        """
+        from deimos.flock import held_exclusively
+        readable = set(readable)
+        recheck = time.time() - self.checked > interval
+        table = None
+        if recheck:
+            self.checked, table = time.time(), held_exclusively()
+        ready = []
+        for mesos_id, (fd, state, calls) in self.containers.items():
+            for call in [call for call in calls if call[0] in readable]:
+                calls.remove(call)                 # Nothing more to read:
+                call[0].close()                    # the client hung up
+            wake = fd in readable or len(calls) == 0
+            if recheck and not wake:
+                wake = (table is None or not state.held("wait", table) or
+                        state.exit() is not None)
+            if wake:
+                if len(calls) > 0:
+                    log.info("Waking %d waits for %s", len(calls), mesos_id)
+                ready += calls
+                os.close(fd)
+                del self.containers[mesos_id]
+        return ready
+
+    def release(self):
+        "All the parked calls, unparked."
+        calls = []
+        for fd, _, waiting in self.containers.values():
+            os.close(fd)
+            calls += waiting
+        self.containers.clear()
+        return calls
+
+    def close(self):
+        "Close the server's copies of descriptors, in a forked child."
+        for fd, _, calls in self.containers.values():
+            os.close(fd)
+            for conn, _, _ in calls:
+                conn.close()
+
+
+def forward(path, argv):
+    """
+    Send a containerizer call to the server at the given path and relay its
+    output and exit code. Returns None if no server is listening, in which
+    case STDIN has not been read and the call may be run locally.
+    """
+    try:
+        request = encode_request(argv[1:], os.environ, os.getcwd())
+    except UnicodeError as e:
+        log.info("Not able to forward %r (%s); running locally", argv, e)
+        return None
+    try:
+        conn = connect(path)
+    except socket.error as e:
+        if e.errno not in [errno.ENOENT, errno.ECONNREFUSED]:
+            raise e
+        log.info("No server on %s; running locally", path)
+        return None
+    sub = argv[1] if len(argv) > 1 else None
+    payload = read_recordio(sys.stdin) if sub in proto_methods else ""
+    send(conn, request)
+    send(conn, payload)
+    accepted = recv(conn)
+    if accepted is None:
+        log.error("Server hung up without accepting the request")
+        return 4
+    pid = json.loads(accepted)["pid"]
+
+    def relay(signum, _):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+    for s in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(s, relay)
+    reply, out = recv(conn), recv(conn)
+    if reply is None or out is None:
+        log.error("Server hung up without replying (worker %d)", pid)
+        return 4
+    sys.stdout.write(out)
+    sys.stdout.flush()
+    return json.loads(reply)["code"]
+
+
+def encode_request(argv, env, cwd):
+    """
+    The request for a call, as JSON. Arguments, the environment and the
+    working directory are byte strings, not necessarily UTF-8 -- Mesos
+    passes the task's environment through -- so each is sent in base64.
+    """
+    return json.dumps({"argv": [b64encode(a) for a in argv],
+                       "env": [[b64encode(k), b64encode(v)]
+                               for k, v in env.items()],
+                       "cwd": b64encode(cwd)})
+
+
+def decode_request(data):
+    "The request sent by encode_request(), with the byte strings restored."
+    request = json.loads(data)
+    return {"argv": [b64decode(a) for a in request["argv"]],
+            "env": dict((b64decode(k), b64decode(v))
+                        for k, v in request["env"]),
+            "cwd": b64decode(request["cwd"])}
+
+
+def connect(path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except socket.error:
+        conn.close()
+        raise
+    return conn
+
+
+def alive(path):
+    try:
+        connect(path).close()
+        return True
+    except socket.error:
+        return False
+
+
+def reap():
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise e
+            return
+        if pid == 0:
+            return
+
+
+def read_recordio(stream):
+    head = stream.read(4)
+    if len(head) != 4:
+        return head
+    size = struct.unpack("I", head)[0]
+    return head + stream.read(size)
+
+
+def send(conn, data):
+    conn.sendall(struct.pack("!I", len(data)) + data)
+
+
+def recv(conn):
+    head = recv_exactly(conn, 4)
+    if head is None:
+        return None
+    return recv_exactly(conn, struct.unpack("!I", head)[0])
+
+
+def frames(data, n):
+    "The first n length-prefixed frames in data, or None if it has fewer."
+    parts, offset = [], 0
+    for _ in range(n):
+        if len(data) < offset + 4:
+            return None
+        size = struct.unpack("!I", data[offset:offset + 4])[0]
+        if len(data) < offset + 4 + size:
+            return None
+        parts += [data[offset + 4:offset + 4 + size]]
+        offset += 4 + size
+    return parts
+
+
+def recv_exactly(conn, size):
+    chunks, remaining = [], size
+    while remaining > 0:
+        try:
+            chunk = conn.recv(remaining)
+        except socket.error as e:
+            if e.errno != errno.EINTR:             # Allows for signal relay
+                raise e
+            continue
+        if chunk == "":
+            return None
+        chunks += [chunk]
+        remaining -= len(chunk)
+    return "".join(chunks)
+
+
+# Subcommands which read a length-prefixed Protobuf from STDIN
+proto_methods = set(["launch", "update", "usage", "wait", "destroy"])
+
+interval = 5.0         # Seconds between checks on parked calls' containers
+
+receive_timeout = 10.0    # Seconds a client has to send its request
+
+
+class Err(deimos.err.Err):
+    pass
@@ -1,6 +1,11 @@
 import errno
+import fcntl
 from fcntl import LOCK_EX, LOCK_NB, LOCK_SH, LOCK_UN
+import fnmatch
+import hashlib
+import heapq
 import itertools
+import json
 import os
 import random
 import signal
@@ -8,6 +13,7 @@ import time
 
 import deimos.docker
 from deimos.err import *
+import deimos.flock
 from deimos.logger import log
 from deimos._struct import _Struct
 from deimos.timestamp import iso
@@ -21,6 +27,9 @@ class State(_Struct):
                                mesos_id=mesos_id,
                                executor_id=executor_id,
                                timestamp=None)
+        self._fields = {}            # From the record, where each is set once
+        self._pending = None         # Writes gathered by batch(), if batching
+        self._found = {}             # Entries found, in either layout
 
     def resolve(self, *args, **kwargs):
         if self.mesos_id is not None:
@@ -62,17 +71,26 @@ class State(_Struct):
         return self.timestamp
 
     def await_cid(self, seconds=60):
-        base = 0.05
-        start = time.time()
-        steps = [1.0, 1.25, 1.6, 2.0, 2.5, 3.2, 4.0, 5.0, 6.4, 8.0]
+        steps = [0.05, 0.0625, 0.08, 0.1, 0.125, 0.16, 0.2, 0.25, 0.32, 0.4]
         scales = (10.0 ** n for n in itertools.count())
         scaled = ([scale * step for step in steps] for scale in scales)
-        sleeps = itertools.chain.from_iterable(scaled)
+        sleeps = itertools.chain.from_iterable(scaled)   # Without inotify
         log.info("Awaiting CID file: %s", self.resolve("cid"))
-        while self.cid(refresh=True) in [None, ""]:
-            time.sleep(next(sleeps))
-            if time.time() - start >= seconds:
-                raise CIDTimeout("No CID file after %ds" % seconds)
+
+        def check():
+            return self.cid(refresh=True) or None
+        from deimos.inotify import wait_for
+        cid = wait_for(self.resolve("cid"), check, seconds, sleeps)
+        if cid is None:
+            raise CIDTimeout("No CID file after %ds" % seconds)
+
+    def await_exit(self, seconds=None):
+        """
+        Wait for the exit file to be written and return the exit code, or
+        None if there is no exit file after the given number of seconds.
+        """
+        from deimos.inotify import wait_for
+        return wait_for(self.resolve("exit"), self.exit, seconds)
 
     def await_launch(self):
         lk_l = self.lock("launch", LOCK_SH)
@@ -84,55 +102,132 @@ class State(_Struct):
         return lk_l
 
     def lock(self, name, flags, seconds=60):
-        fmt_time = "indefinite" if seconds is None else "%ds" % seconds
+        fmt_time = "indefinite" if seconds is None else "%gs" % seconds
         fmt_flags = deimos.flock.format_lock_flags(flags)
         flags, seconds = deimos.flock.nb_seconds(flags, seconds)
         log.info("request // %s %s (%s)", name, fmt_flags, fmt_time)
         p = self.resolve(os.path.join("lock", name), mkdir=True)
         lk = deimos.flock.LK(p, flags, seconds)
+        t = time.time()
         try:
             lk.lock()
         except deimos.flock.Err:
             log.error("failure // %s %s (%s)", name, fmt_flags, fmt_time)
+            self._lockstats("fail", name, flags, time.time() - t)
             raise
+        self._lockstats("wait", name, flags, time.time() - t)
+        if lock_stats:
+            lk.on_unlock = lambda held: self._lockstats("hold", name, flags,
+                                                        held)
         if (flags & LOCK_EX) != 0:
-            lk.handle.write(iso() + "\n")
+            lk.stamp(iso() + "\n")
         log.info("success // %s %s (%s)", name, fmt_flags, fmt_time)
         return lk
 
+    def _lockstats(self, kind, name, flags, seconds):
+        if lock_stats:
+            from deimos.lockstats import record
+            mode = "EX" if (flags & LOCK_EX) != 0 else "SH"
+            record(self.root, kind, name, mode, seconds,
+                   self.mesos_id or self.docker_id)
+
+    def held(self, name, table):
+        """
+        Whether the named lock's file has a lock in the table, as from
+        deimos.flock.held_exclusively(); see deimos.flock.held_on().
+        """
+        path = self.resolve(os.path.join("lock", name))
+        return len(deimos.flock.held_on(table, path)) > 0
+
     def exit(self, value=None):
-        if value is not None:
-            self._writef("exit", str(value))
+        if value is not None:          # Waiters read it as soon as it's there
+            self._writef("exit", str(value), atomic=True)
+            self._index(exit=str(value))
+            self._broadcast("exit")
         data = self._readf("exit")
-        if data is not None:
+        if data:
             return deimos.docker.read_wait_code(data)
 
+    def subscribe(self, name):
+        """
+        A descriptor that becomes readable once the named property is next
+        written, or None if there is no way to be told. It is the reading
+        end of a FIFO in the state directory, which everyone waiting on the
+        property shares; a write opens and closes the other end, waking them
+        all at once, and each waiter costs only a descriptor. Check the
+        property after subscribing, not before, so as not to miss a write.
+        """
+        p = self.resolve(name + ".fifo")
+        try:
+            os.mkfifo(p, 0644)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                log.debug("Not able to make %s: %s", p, e)
+                return None
+        try:
+            return os.open(p, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError as e:
+            log.debug("Not able to open %s: %s", p, e)
+            return None
+
+    def _broadcast(self, name):
+        "Wake everyone subscribed to the named property."
+        try:
+            fd = os.open(self.resolve(name + ".fifo"),
+                         os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno not in [errno.ENOENT, errno.ENXIO]:   # ENXIO: no one
+                log.debug("Not able to wake %s subscribers: %s", name, e)
+            return
+        os.close(fd)                # Readers see the hangup, and wake
+
+    def mtime(self, name):
+        "When the named property was last written."
+        if backend == "record" and name in self._record():
+            name = "state.json"
+        return os.stat(self.resolve(name)).st_mtime
+
     def push(self):
         self._mkdir()
         properties = [("cid", self.docker_id),
                       ("mesos-container-id", self.mesos_id),
                       ("eid", self.executor_id)]
-        self.set_start_time()
-        for k, v in properties:
-            if v is not None and not os.path.exists(self.resolve(k)):
-                self._writef(k, v)
-        if self.cid() is not None:
-            docker = os.path.join(self.root, "docker", self.cid())
-            link("../mesos/" + self.mesos_id, docker)
+        if backend == "record":
+            fields = dict((k, v) for k, v in properties if v is not None)
+            if self.t() is None:
+                self.timestamp = self._claim_start_time()
+            if self.timestamp is not None:
+                fields["t"] = self.timestamp
+            self._update(fields, overwrite=False)
+        else:
+            self.set_start_time()
+            for k, v in properties:
+                if v is not None and not os.path.exists(self.resolve(k)):
+                    self._writef(k, v)
+        cid = self.cid()            # Until Docker writes it, each call stats
+        if cid is not None:
+            docker = self._locate("docker", cid)
+            link(os.path.relpath(self._mesos(), os.path.dirname(docker)),
+                 docker)
+        self._index(docker_id=cid, start=self.t())
 
     def set_start_time(self):
         if self.t() is not None:
             return
-        d = os.path.abspath(os.path.join(self.root, "start-time"))
-        create(d)
+        t = self._claim_start_time()
+        if t is not None:
+            self._writef("t", t)
+            self.timestamp = t
+
+    def _claim_start_time(self):
         start, t = time.time(), iso()
         while time.time() - start <= 1.0:
             try:
-                p = os.path.join(d, t)
-                os.symlink("../mesos/" + self.mesos_id, p)
-                self._writef("t", t)
-                self.timestamp = t
-                return
+                p = entry(self.root, "start-time", t)
+                create(os.path.dirname(p))
+                os.symlink(os.path.relpath(self._mesos(), os.path.dirname(p)),
+                           p)
+                return t
             except OSError as e:
                 if e.errno != errno.EEXIST:
                     raise
@@ -143,25 +238,98 @@ class State(_Struct):
         create(self._mesos())
 
     def _readf(self, path):
-        f = self.resolve(path)
-        if os.path.exists(f):
-            with open(f) as h:
-                return h.read().strip()
+        if backend == "record":
+            if path not in self._fields and self._pending is None:
+                self._fields.update(self._record())
+            if path in self._fields or path != "cid":
+                return self._fields.get(path)
+        return cached(self.resolve(path), str.strip)  # Docker writes "cid"
+
+    def _writef(self, path, value, atomic=False):
+        if backend == "record":
+            self._update({path: value})
+            return
+        mode = "atomic" if atomic and durability == "none" else durability
+        from deimos.durability import write
+        write(self.resolve(path), value + "\n", mode, self._sync_lock())
 
-    def _writef(self, path, value):
-        f = self.resolve(path)
-        with open(f, "w+") as h:
-            h.write(value + "\n")
-            h.flush()
+    def _sync_lock(self):
+        return os.path.join(self.root, "sync")
+
+    def _index(self, **fields):
+        if index is None:
+            return
+        from deimos.index import failures
+        try:
+            index.record(self.mesos_container_id(), **fields)
+        except failures as e:
+            log.warning("Not able to update the index (%s); rebuild it with "
+                        "`deimos state --reindex`", e)
+
+    def _record(self):
+        return read_record(self.resolve("state.json"))
+
+    def batch(self):
+        """
+        Under the record backend, hold back the writes that follow until
+        flush(), which makes them all in one update of the record. Until then
+        only this State sees them. Launch writes a handful of fields while it
+        holds the launch lock, and so replaces the record once, not each time.
+        The record is read once, here, and not again until the flush: fields
+        it lacks are taken to be unset, except for Docker's cid file.
+        """
+        if backend == "record" and self._pending is None:
+            self._fields.update(self._record())
+            self._pending = {}
+
+    def flush(self):
+        pending, self._pending = self._pending, None
+        if pending:
+            self._commit(pending)
+
+    def _update(self, fields, overwrite=True):
+        if self._pending is not None:
+            for k, v in fields.items():
+                if overwrite or k not in self._fields:
+                    self._pending[k] = (v, overwrite)
+                    self._fields[k] = v
+            return
+        self._commit(dict((k, (v, overwrite)) for k, v in fields.items()))
+
+    def _commit(self, updates):
+        """
+        Merge updates -- a value for each field, and whether it replaces one
+        already in the record -- into the state record and replace it with a
+        rename, so readers see the old record or the new one and never a
+        partial write. Writers are serialized by a lock on the state
+        directory itself.
+        """
+        path = self.resolve("state.json")
+        fd = os.open(os.path.dirname(path), os.O_RDONLY)
+        try:
+            fcntl.flock(fd, LOCK_EX)
+            record = read_record(path)
+            changes = dict((k, v) for k, (v, overwrite) in updates.items()
+                           if overwrite or k not in record)
+            if not changes:
+                return
+            record.update(changes)
+            data = json.dumps(record, separators=(",", ":"))
+            mode = "atomic" if durability == "none" else durability
+            from deimos.durability import write
+            write(path, data, mode, self._sync_lock())
+            self._fields.update(record)
+        finally:
+            os.close(fd)                           # Releases the lock, too
 
     def _docker(self, path=None, mkdir=False):
+        docker = self._locate("docker", self.docker_id)
         if path is None:
-            p = os.path.join(self.root, "docker", self.docker_id)
+            p = docker
         else:
-            p = os.path.join(self.root, "docker", self.docker_id, path)
+            p = os.path.join(docker, path)
         p = os.path.abspath(p)
         if mkdir:
-            docker = os.path.join(self.root, "docker", self.docker_id)
             if not os.path.exists(docker):
                 log.error("No Docker symlink (this should be impossible)")
                 raise Err("Bad Docker symlink state")
@@ -170,9 +338,9 @@ class State(_Struct):
 
     def _mesos(self, path=None, mkdir=False):
         if path is None:
-            p = os.path.join(self.root, "mesos", self.mesos_id)
+            p = self._locate("mesos", self.mesos_id)
         else:
-            p = os.path.join(self.root, "mesos", self.mesos_id, path)
+            p = os.path.join(self._locate("mesos", self.mesos_id), path)
         p = os.path.abspath(p)
         if mkdir:
             create(os.path.dirname(p))
@@ -190,13 +358,22 @@ class State(_Struct):
     def exists(self):
         path = None
         if self.mesos_id is not None:
-            path = os.path.join(self.root, "mesos", self.mesos_id)
+            path = self._locate("mesos", self.mesos_id)
         if self.docker_id is not None:
-            path = os.path.join(self.root, "docker", self.docker_id)
+            path = self._locate("docker", self.docker_id)
         if path is not None:
             return os.path.exists(path)
         return False
 
+    def _locate(self, kind, ident):
+        key = (kind, ident)
+        if key in self._found:
+            return self._found[key]
+        path, found = locate(self.root, kind, ident)
+        if found:
+            self._found[key] = path
+        return path
+
 
 class CIDTimeout(Err):
     pass
@@ -215,8 +392,187 @@ def link(source, target):
 
 def state(directory):
     mesos = os.path.join(directory, "mesos-container-id")
-    if os.path.exists(mesos):
+    mesos_id = read_record(os.path.join(directory, "state.json")).get(
+        "mesos-container-id")
+    if mesos_id is None and os.path.exists(mesos):
         with open(mesos) as h:
             mesos_id = h.read().strip()
-        root = os.path.dirname(os.path.dirname(os.path.realpath(directory)))
-        return State(root=root, mesos_id=mesos_id)
+    if mesos_id is not None:
+        parent = os.path.dirname(os.path.realpath(directory))
+        if os.path.basename(parent) != "mesos":        # In a shard
+            parent = os.path.dirname(parent)
+        return State(root=os.path.dirname(parent), mesos_id=mesos_id)
+
+
+def shard(kind, ident):
+    """
+    The subdirectory for an entry in the sharded layout: the day, for start
+    times, and otherwise the first two hex digits of the ID's SHA-1, so that
+    no directory grows past a few thousand entries.
+    """
+    if kind == "start-time":
+        return ident[:10]
+    return hashlib.sha1(ident).hexdigest()[:2]
+
+
+def is_shard(kind, name):
+    if kind == "start-time":
+        return len(name) == 10 and "T" not in name
+    return len(name) == 2 and all(c in "0123456789abcdef" for c in name)
+
+
+def entry(root, kind, ident, sharded=None):
+    "Where the entry goes in a layout (by default, the configured one)."
+    if sharded is None:
+        sharded = layout == "sharded"
+    if sharded:
+        return os.path.join(root, kind, shard(kind, ident), ident)
+    return os.path.join(root, kind, ident)
+
+
+def locate(root, kind, ident):
+    """
+    Find an entry -- a state directory, or a symlink to one -- in the
+    configured layout or, failing that, in the other one. Returns the path
+    and whether it exists; where it doesn't, the path is the one it would
+    have in the configured layout.
+    """
+    preferred = entry(root, kind, ident)
+    if os.path.lexists(preferred):
+        return preferred, True
+    other = entry(root, kind, ident, sharded=(layout != "sharded"))
+    if os.path.lexists(other):
+        return other, True
+    return preferred, False
+
+
+def entries(root, kind):
+    "Pairs of ID and path for every entry of the kind, in both layouts."
+    directory = os.path.join(root, kind)
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not is_shard(kind, name):
+            yield name, path
+            continue
+        try:
+            names = os.listdir(path)
+        except OSError as e:                       # Emptied and removed
+            if e.errno not in [errno.ENOENT, errno.ENOTDIR]:
+                raise e
+            continue
+        for ident in names:
+            yield ident, os.path.join(path, ident)
+
+
+def start_times(root, before=None, after=None):
+    """
+    Pairs of start time and start-time/ entry, oldest first, for containers
+    started before the ISO 8601 timestamp (or for all of them), and after
+    the other, if given. Day subdirectories of the sharded layout are read in
+    order and only between the two days, and the scan stops at the first
+    entry past the cutoff, so entries outside the range are not listed;
+    entries in the flat layout have to be read in full.
+    """
+    directory = os.path.join(root, "start-time")
+    try:
+        names = os.listdir(directory)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise e
+        return
+    days = sorted(name for name in names if is_shard("start-time", name))
+    loose = sorted(name for name in names
+                   if not is_shard("start-time", name))
+
+    def bucketed():
+        for day in days:
+            if before is not None and day > before[:10]:
+                return
+            if after is not None and day < after[:10]:
+                continue
+            try:
+                ts = sorted(os.listdir(os.path.join(directory, day)))
+            except OSError as e:                   # Emptied and removed
+                if e.errno not in [errno.ENOENT, errno.ENOTDIR]:
+                    raise e
+                continue
+            for t in ts:
+                yield t, os.path.join(directory, day, t)
+    flat = ((t, os.path.join(directory, t)) for t in loose)
+    for t, path in heapq.merge(flat, bucketed()):
+        if before is not None and t >= before:
+            return
+        if after is not None and t <= after:
+            continue
+        if fnmatch.fnmatch(t, "????-??-??T*.*Z"):
+            yield t, path
+
+
+def exited(directory):
+    "Whether the state directory records an exit, under either backend."
+    if os.path.exists(os.path.join(directory, "exit")):
+        return True
+    return "exit" in read_record(os.path.join(directory, "state.json"))
+
+
+def read_record(path):
+    return dict(cached(path, parse_record) or {})
+
+
+def parse_record(data):
+    return dict((str(k), str(v)) for k, v in json.loads(data).items())
+
+
+def cached(path, parse):
+    """
+    The parsed contents of the file, or None if there is no such file.
+    Results are kept and reused for as long as the file's inode, size, mtime
+    and ctime stay the same, so that reading an unchanged file again costs a
+    single stat(). State files are written once, or replaced by a rename, so
+    every change shows up in one of these.
+    """
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        if e.errno not in [errno.ENOENT, errno.ENOTDIR]:
+            raise e
+        _reads.pop(path, None)
+        return None
+    signature = (st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+    hit = _reads.get(path)
+    if hit is not None and hit[0] == signature:
+        return hit[1]
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:                    # Removed since the stat() above
+        if e.errno not in [errno.ENOENT, errno.ENOTDIR]:
+            raise e
+        return None
+    try:
+        chunks = [os.read(fd, 65536)]           # State files are much smaller
+        while len(chunks[-1]) == 65536:
+            chunks += [os.read(fd, 65536)]
+    finally:
+        os.close(fd)
+    value = parse("".join(chunks))
+    if len(_reads) >= 1024:
+        _reads.clear()
+    _reads[path] = (signature, value)
+    return value
+
+_reads = {}
+
+
+# Global settings
+
+backend = "files"  # Or "record": one state.json per container, see _commit()
+
+index = None       # A deimos.index.Index, when the index is enabled
+
+durability = "none"  # See deimos.durability.write()
+
+layout = "flat"    # Or "sharded": see shard(); both are always readable
+
+lock_stats = True  # Record lock metrics, with deimos.lockstats.record()
@@ -1,7 +1,9 @@
 import time
 
 
-def iso(t=time.time()):
+def iso(t=None):
+    if t is None:
+        t = time.time()
     ms = ("%0.03f" % (t % 1))[1:]
     iso = time.strftime("%FT%T", time.gmtime(t))
     return iso + ms + "Z"